@@ -1,10 +1,9 @@
 from cary.carycommand import CaryCommand, CaryAction
 import os
-from cary_perdiemcommand.perdiem_database import PerdiemDatabase
-from jinja2 import Environment, FileSystemLoader, DebugUndefined
-from cary_travelcommand.travel_parser import trip_parser, AirportLookup
-from cary_travelcommand.travel_parser import TrainStationLookup
 from cary_travelcommand.travel_calculations import adjusted_trip_costs
+from cary_travelcommand.perdiem_cache import shared_perdiem_database
+from cary_travelcommand.estimator_registry import shared_estimators
+from cary_travelcommand.perdiem_arrays import DayCosts, vectorized_available
 from cary_travelcommand import __path__ as MODULE_PATH
 import logging
 
@@ -27,13 +26,19 @@ class TravelCommand(CaryCommand):
 
 
 def lodgingcost_filter(leg):
-    return sum([day['lodging_actual'] for day in leg['costs']['dates']
-                if leg['costs']['matched_location'] is not None])
+    if leg['costs']['matched_location'] is None:
+        return 0
+    if isinstance(leg['costs']['dates'], DayCosts):
+        return leg['costs']['dates'].lodging_total()
+    return sum([day['lodging_actual'] for day in leg['costs']['dates']])
 
 
 def miecost_filter(leg):
-    return sum([day['mie_actual'] for day in leg['costs']['dates']
-                if leg['costs']['matched_location'] is not None])
+    if leg['costs']['matched_location'] is None:
+        return 0
+    if isinstance(leg['costs']['dates'], DayCosts):
+        return leg['costs']['dates'].mie_total()
+    return sum([day['mie_actual'] for day in leg['costs']['dates']])
 
 
 def dollars_filter(value):
@@ -47,7 +52,8 @@ def mean_filter(value):
 def trip_travel_cost(costs):
     def leg_travel_cost(leg):
         travel_cost = leg['costs']['travel_cost']
-        return mean_filter(travel_cost['fares']) if travel_cost['found'] else 0
+        return mean_filter(travel_cost['fares']) \
+          if travel_cost is not None and travel_cost['found'] else 0
     return sum([leg_travel_cost(leg) for leg in costs])
 
 
@@ -72,7 +78,8 @@ def poor_matches_exist(costs):
 
 
 def poor_matches(costs):
-    return [leg['costs']['searched_location'] for leg in costs
+    return [leg['costs']['searched_location'] or "(no stay location)"
+            for leg in costs
             if (leg['costs']['matched_location'] is None)
             or (leg['costs']['score'] < 90 if 'score' in leg['costs'] else False)]
 
@@ -99,8 +106,72 @@ class TravelAction(CaryAction):
             if 'PERDIEM_THRESHOLD' in self.config \
                else 90
 
+    @property
+    def perdiem_cache_filename(self):
+        return self.config['PERDIEM_CACHE_FILENAME'] \
+            if 'PERDIEM_CACHE_FILENAME' in self.config \
+               else None
+
+    @property
+    def estimate_workers(self):
+        return self.config['ESTIMATE_WORKERS'] \
+            if 'ESTIMATE_WORKERS' in self.config \
+               else 1
+
+    @property
+    def estimate_deadline(self):
+        deadline = self.config['ESTIMATE_DEADLINE'] \
+            if 'ESTIMATE_DEADLINE' in self.config \
+               else None
+        if deadline is not None and self.estimate_workers <= 1:
+            logging.warning("ESTIMATE_DEADLINE needs ESTIMATE_WORKERS > 1; "
+                            "ignoring it")
+            return None
+        return deadline
+
+    @property
+    def pair_roundtrips(self):
+        return self.config['PAIR_ROUNDTRIPS'] \
+            if 'PAIR_ROUNDTRIPS' in self.config \
+               else True
+
+    @property
+    def parser_engine(self):
+        return self.config['PARSER_ENGINE'] \
+            if 'PARSER_ENGINE' in self.config \
+               else "fast"
+
+    @property
+    def vectorized_perdiem(self):
+        vectorized = self.config['VECTORIZED_PERDIEM'] \
+            if 'VECTORIZED_PERDIEM' in self.config \
+               else False
+        if vectorized and not vectorized_available():
+            logging.warning("VECTORIZED_PERDIEM needs numpy; ignoring it")
+            return False
+        if vectorized and self.compress_spans:
+            logging.warning("COMPRESS_SPANS is set; ignoring "
+                            "VECTORIZED_PERDIEM")
+            return False
+        return vectorized
+
+    @property
+    def compress_spans(self):
+        return self.config['COMPRESS_SPANS'] \
+            if 'COMPRESS_SPANS' in self.config \
+               else False
+
     def execute_action(self):
-        self.estimators = self.config['cost_estimators'] \
+        # jinja2 and the trip grammar (pyparsing) are only needed once
+        # there is a message to parse and a reply to render, so they
+        # aren't imported with the command
+        from jinja2 import Environment, FileSystemLoader, DebugUndefined
+        from cary_travelcommand.travel_parser import iter_trip_legs, legs_only
+        from cary_travelcommand.travel_parser import AirportLookup
+        from cary_travelcommand.travel_parser import TrainStationLookup
+        from cary_travelcommand.endpoint_index import endpoint_index
+        from cary_travelcommand.lookup_registry import shared_lookup
+        self.estimators = shared_estimators(self.config['cost_estimators']) \
           if 'cost_estimators' in self.config else []
         self.environment = Environment(loader=FileSystemLoader(
             self.template_path
@@ -115,36 +186,54 @@ class TravelAction(CaryAction):
         self.environment.filters['trip_lodging_cost'] = trip_lodging_cost
         self.environment.filters['trip_mie_cost'] = trip_mie_cost
         self.environment.filters['trip_total_cost'] = trip_total_cost
-        self.lookups = [AirportLookup(self.config['AIRPORT_DATA']),
-                        TrainStationLookup(self.config['TRAIN_STATION_DATA'])]
-
-        self.pd = PerdiemDatabase(self.config['LOCSTRING_FILENAME'],
-                                  self.config['DB_FILENAME'])
-
-        tp = trip_parser(self.lookups)
-        self.trip = tp.parseString(self._message.body)
+        self.lookups = [
+            shared_lookup(AirportLookup, self.config['AIRPORT_DATA']),
+            shared_lookup(TrainStationLookup,
+                          self.config['TRAIN_STATION_DATA'])]
+
+        self.pd = shared_perdiem_database(self.config['LOCSTRING_FILENAME'],
+                                          self.config['DB_FILENAME'],
+                                          self.perdiem_cache_filename)
+
+        # legs are costed as they are parsed; lines which can't be
+        # parsed are reported back rather than failing the estimate
+        self.skipped_lines = []
+        self.trip = legs_only(iter_trip_legs(self._message.body,
+                                             self.lookups,
+                                             self.parser_engine),
+                              self.skipped_lines)
         logging.debug("seeking adjusted trip costs with threshold {0}".format(
             self.threshold))
         self.costs = adjusted_trip_costs(self.trip, self.pd, self.estimators,
-                                         self.threshold)
+                                         self.threshold,
+                                         endpoint_index(self.lookups),
+                                         max_workers=self.estimate_workers,
+                                         deadline=self.estimate_deadline,
+                                         pair_roundtrips=self.pair_roundtrips,
+                                         vectorized=self.vectorized_perdiem,
+                                         spans=self.compress_spans)
         self._output_filenames = []
 
         self._perdiem_text_plain = self.environment.get_template(
             'plaintext_template.txt'
             ).render(costs=self.costs,
                      poor_matches_exist=poor_matches_exist(self.costs),
-                     poor_matches=poor_matches(self.costs)
+                     poor_matches=poor_matches(self.costs),
+                     skipped_lines=self.skipped_lines
                      )
         self._perdiem_text_html = self.environment.get_template(
             'html_template.html'
             ).render(costs=self.costs,
                      poor_matches_exist=poor_matches_exist(self.costs),
-                     poor_matches=poor_matches(self.costs)
+                     poor_matches=poor_matches(self.costs),
+                     skipped_lines=self.skipped_lines
                      )
 
     @property
     def response_subject(self):
-        return "Your travel estimate ({0})".format(self.trip[0]['staying_in'])
+        return "Your travel estimate ({0})".format(
+            self.costs[0]['staying_in'] if len(self.costs) > 0
+            else "no legs recognised")
 
     @property
     def response_body(self):
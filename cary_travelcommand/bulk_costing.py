@@ -0,0 +1,197 @@
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import logging
+from cary_travelcommand.travel_parser import parse_trip
+from cary_travelcommand.travel_calculations import inferred_routes
+from cary_travelcommand.travel_calculations import trip_costs_by_perdiems
+from cary_travelcommand.travel_calculations import trips_route_estimates
+from cary_travelcommand.travel_calculations import calculated_trip_costs
+from cary_travelcommand.travel_calculations import unlocated_perdiem
+from cary_travelcommand.lookup_registry import shared_lookup
+from cary_travelcommand.perdiem_cache import CachedPerdiemDatabase
+from cary_travelcommand.perdiem_cache import shared_perdiem_database
+from cary_travelcommand.perdiem_cache import normalized_location
+from cary_travelcommand.endpoint_index import endpoint_index
+
+# the costs of one trip, and the lines of it which couldn't be parsed
+TripCosts = namedtuple('TripCosts', 'costs skipped_lines')
+
+# the lookups and per diem database of this (worker) process
+_WORKER = {}
+
+
+def _init_worker(locstrings_filename, database_filename, cache_filename,
+                 database_factory, lookup_files):
+    if database_factory is None:
+        _WORKER['pd'] = shared_perdiem_database(
+            locstrings_filename, database_filename, cache_filename)
+    else:
+        _WORKER['pd'] = CachedPerdiemDatabase(
+            locstrings_filename, database_filename, cache_filename,
+            database_factory=database_factory)
+    _WORKER['lookups'] = [shared_lookup(lookup_class, filename)
+                          for (lookup_class, filename) in lookup_files]
+    _WORKER['initargs'] = (locstrings_filename, database_filename,
+                           cache_filename, database_factory, lookup_files)
+
+
+def _parse_trip(text, engine):
+    return parse_trip(text, _WORKER['lookups'], engine)
+
+
+def _perdiem_query(key):
+    (location, threshold) = key
+    return _WORKER['pd'].perdiem_query(location, threshold=threshold)
+
+
+class BulkTripCoster():
+    """
+    Costs many trips (for budgeting runs) as adjusted_trip_costs would
+    one at a time, but a batch of batch_size trips at once:
+
+      * message bodies are parsed, and per diem queries made, on a pool
+        of processes processes (0 to work in this process), each of
+        which loads the lookups and per diem database just once;
+      * each distinct staying_in location is only queried once per
+        coster, however many legs share it;
+      * the fare searches for the whole batch are made together, each
+        distinct search once (see trips_route_estimates), in this
+        process, since estimators keep their caches and quotas here.
+
+    Trips may be message bodies or lists of legs; costs() yields a
+    TripCosts for each, in order, as each batch is finished.  Use the
+    coster as a context manager (or call close) to stop the pool.
+    """
+
+    def __init__(self, locstrings_filename, database_filename,
+                 route_estimators=[], threshold=90, lookup_files=[],
+                 perdiem_cache_filename=None, database_factory=None,
+                 processes=None, batch_size=500, max_workers=1,
+                 deadline=None, pair_roundtrips=True, vectorized=False,
+                 spans=False, parser_engine="fast"):
+        self.route_estimators = route_estimators
+        self.threshold = threshold
+        self.lookup_files = list(lookup_files)
+        self.processes = processes
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.pair_roundtrips = pair_roundtrips
+        self.vectorized = vectorized
+        self.spans = spans
+        self.parser_engine = parser_engine
+        self._initargs = (locstrings_filename, database_filename,
+                          perdiem_cache_filename, database_factory,
+                          self.lookup_files)
+        self._executor = None
+        self._endpoints = None
+        self.perdiems = {}
+        self.legs_costed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _map(self, function, items):
+        if len(items) == 0:
+            return []
+        if self.processes == 0:
+            if _WORKER.get('initargs') != self._initargs:
+                _init_worker(*self._initargs)
+            return list(map(function, items))
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes, initializer=_init_worker,
+                initargs=self._initargs)
+        chunksize = max(1, len(items) // (4 * (self.processes or 4)))
+        return list(self._executor.map(function, items, chunksize=chunksize))
+
+    @property
+    def endpoints(self):
+        if self._endpoints is None and len(self.lookup_files) > 0:
+            self._endpoints = endpoint_index(
+                [shared_lookup(lookup_class, filename)
+                 for (lookup_class, filename) in self.lookup_files])
+        return self._endpoints
+
+    def stats(self):
+        return dict(legs=self.legs_costed, perdiem_queries=len(self.perdiems))
+
+    def perdiem_key(self, leg):
+        if leg['staying_in'] is None:
+            return None
+        return (normalized_location(leg['staying_in']), self.threshold)
+
+    def perdiem(self, leg):
+        key = self.perdiem_key(leg)
+        if key is None:
+            return unlocated_perdiem()
+        return dict(self.perdiems[key],
+                    original_search_location=leg['staying_in'])
+
+    def _cost_batch(self, trips):
+        texts = [n for (n, trip) in enumerate(trips) if isinstance(trip, str)]
+        parsed = self._map(partial(_parse_trip, engine=self.parser_engine),
+                           [trips[n] for n in texts])
+        legs = [None if isinstance(trip, str) else list(trip)
+                for trip in trips]
+        skipped = [[] for trip in trips]
+        for (n, (trip_legs, errors)) in zip(texts, parsed):
+            legs[n] = trip_legs
+            skipped[n] = errors
+        if self.endpoints is not None:
+            legs = [list(inferred_routes(trip_legs, self.endpoints))
+                    for trip_legs in legs]
+
+        keys = OrderedDict()
+        for trip_legs in legs:
+            for leg in trip_legs:
+                key = self.perdiem_key(leg)
+                if key is not None and key not in self.perdiems:
+                    keys[key] = None
+        keys = list(keys)
+        logging.debug("querying {0} new per diem locations".format(len(keys)))
+        for (key, result) in zip(keys, self._map(_perdiem_query, keys)):
+            self.perdiems[key] = result
+
+        costs = [trip_costs_by_perdiems(
+                     trip_legs,
+                     [self.perdiem(leg) for leg in trip_legs],
+                     self.vectorized, self.spans)
+                 for trip_legs in legs]
+        travel_costs = trips_route_estimates(costs, self.route_estimators,
+                                             self.max_workers, self.deadline,
+                                             self.pair_roundtrips)
+        for (trip_costs, trip_travel_costs, errors) in \
+          zip(costs, travel_costs, skipped):
+            self.legs_costed += len(trip_costs)
+            yield TripCosts(calculated_trip_costs(
+                trip_costs, travel_costs=trip_travel_costs), errors)
+
+    def costs(self, trips):
+        batch = []
+        for trip in trips:
+            batch.append(trip)
+            if len(batch) >= self.batch_size:
+                yield from self._cost_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            yield from self._cost_batch(batch)
+
+
+def bulk_trip_costs(trips, locstrings_filename, database_filename, **kwargs):
+    """
+    Yields a TripCosts for each of trips in order (see BulkTripCoster
+    for the keyword arguments)
+    """
+    with BulkTripCoster(locstrings_filename, database_filename,
+                        **kwargs) as coster:
+        yield from coster.costs(trips)
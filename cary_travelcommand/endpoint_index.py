@@ -0,0 +1,213 @@
+from functools import lru_cache
+import re
+
+
+WILDCARD = "?"
+
+
+def location_tokens(text):
+    """
+    Lower-cased alphanumeric words of a place name
+    """
+    return re.findall(r"[a-z0-9]+", (text or '').lower())
+
+
+def wildcard_keys(code):
+    """
+    The code with each position in turn replaced by a wildcard; two
+    codes of the same length one substitution apart share a key
+    """
+    return [code[:i] + WILDCARD + code[i + 1:] for i in range(len(code))]
+
+
+class TypoIndex():
+    """
+    Finds the codes a single typo (substitution, insertion, deletion
+    or transposition of adjacent letters) away from a given string.
+    Codes are short and the typos we care about are single ones, so a
+    wildcard neighbourhood map answers in a handful of dict lookups
+    instead of scanning or walking a metric tree.
+    """
+
+    def __init__(self, codes=[]):
+        self.codes = set()
+        self.neighbours = {}
+        for code in codes:
+            self.add(code)
+
+    def add(self, code):
+        self.codes.add(code)
+        for key in wildcard_keys(code):
+            self.neighbours.setdefault(key, set()).add(code)
+
+    def candidates(self, typo):
+        """
+        Returns {code: rank}; swapped letters are the most likely typo
+        so they rank 0, every other single edit ranks 1
+        """
+        result = {}
+        # substitutions
+        for key in wildcard_keys(typo):
+            for code in self.neighbours.get(key, ()):
+                result[code] = 1
+        # a letter missing from the typo
+        for i in range(len(typo) + 1):
+            for code in self.neighbours.get(typo[:i] + WILDCARD + typo[i:], ()):
+                result[code] = 1
+        # an extra letter in the typo
+        for i in range(len(typo)):
+            if typo[:i] + typo[i + 1:] in self.codes:
+                result[typo[:i] + typo[i + 1:]] = 1
+        # adjacent letters swapped
+        for i in range(len(typo) - 1):
+            swapped = typo[:i] + typo[i + 1] + typo[i] + typo[i + 2:]
+            if swapped in self.codes:
+                result[swapped] = 0
+        result.pop(typo, None)
+        return result
+
+
+class EndpointIndex():
+    """
+    A single view over the endpoint codes of a set of
+    RoutePointLookups, in lookup order.  Codes are resolved by each
+    lookup itself (by bisection for a SnapshotLookup), so no records
+    are copied; the typo index for suggestions and the city index for
+    inferring routes are built from the lookups on first use.  The
+    lookups are expected not to change once indexed (see
+    lookup_registry).
+    """
+
+    def __init__(self, lookups):
+        self.lookups = list(lookups)
+        self._typos = None
+        self._cities = None
+
+    def __contains__(self, code):
+        return any(lookup.is_valid_endpoint(code) for lookup in self.lookups)
+
+    def entries(self, code):
+        """
+        [(mode, record)] for the code, in lookup order
+        """
+        return [(lookup.mode, lookup.record(code)) for lookup in self.lookups
+                if lookup.is_valid_endpoint(code)]
+
+    def modes(self, code):
+        return [lookup.mode for lookup in self.lookups
+                if lookup.is_valid_endpoint(code)]
+
+    def route_mode(self, start, end):
+        """
+        The first mode (in lookup order) serving both ends, or None
+        """
+        end_modes = self.modes(end)
+        for mode in self.modes(start):
+            if mode in end_modes:
+                return mode
+        return None
+
+    @property
+    def typos(self):
+        if self._typos is None:
+            self._typos = TypoIndex(code for lookup in self.lookups
+                                    for code in lookup.codes())
+        return self._typos
+
+    def suggestions(self, code, limit=5):
+        """
+        Known codes one typo away from an unrecognised one, most
+        likely first: swapped letters, then codes sharing the first
+        letter, then alphabetically
+        """
+        candidates = self.typos.candidates(code)
+        return sorted(candidates,
+                      key=lambda candidate: (candidates[candidate],
+                                             candidate[:1] != code[:1],
+                                             candidate))[:limit]
+
+
+    @property
+    def cities(self):
+        if self._cities is None:
+            self._cities = CityIndex(self.lookups)
+        return self._cities
+
+    def nearest_endpoint(self, location, mode, origin=None):
+        """
+        The code (of the given mode) best matching a "staying in"
+        location, preferring the origin's country and then
+        international airports, or None
+        """
+        origin_country = None
+        for (origin_mode, record) in \
+          self.entries(origin) if origin is not None else []:
+            if origin_mode == mode:
+                origin_country = record.get('country')
+        candidates = self.cities.candidates(location, mode)
+        if len(candidates) == 0:
+            return None
+        return min(candidates,
+                   key=lambda c: (-c[0], c[2] != origin_country,
+                                  not c[3], c[1]))[1]
+
+
+class CityIndex():
+    """
+    Inverted index from city name words to endpoint codes, so a
+    location such as "Manchester, United Kingdom" is resolved with a
+    few set intersections rather than a scan of every airport
+    """
+
+    def __init__(self, lookups):
+        self.city_words = {}
+        self.places = {}
+        for lookup in lookups:
+            mode = lookup.mode
+            for (code, record) in lookup.records():
+                city = location_tokens(record.get('city'))
+                if len(city) == 0:
+                    continue
+                for word in city:
+                    self.city_words.setdefault(word, set()).add((mode, code))
+                self.places[(mode, code)] = (
+                    frozenset(location_tokens(record.get('state'))
+                              + location_tokens(record.get('country'))),
+                    record.get('country'),
+                    'international' in location_tokens(record.get('name')))
+
+    def candidates(self, location, mode):
+        """
+        Returns [(score, code, country, international)] for endpoints
+        of this mode whose city contains every word of the location's
+        first part; the score counts the remaining words (state,
+        country) matched
+        """
+        parts = (location or '').split(",", 1)
+        city = location_tokens(parts[0])
+        rest = location_tokens(parts[1]) if len(parts) > 1 else []
+        if len(city) == 0:
+            return []
+        matches = set.intersection(*[self.city_words.get(word, set())
+                                     for word in city])
+        result = []
+        for (match_mode, code) in matches:
+            if match_mode != mode:
+                continue
+            place_words, country, international = \
+              self.places[(match_mode, code)]
+            score = len([word for word in rest if word in place_words])
+            result.append((score, code, country, international))
+        return result
+
+
+@lru_cache(maxsize=8)
+def _endpoint_index(lookups):
+    return EndpointIndex(lookups)
+
+
+def endpoint_index(lookups):
+    """
+    The shared EndpointIndex for this set of lookups
+    """
+    return _endpoint_index(tuple(lookups))
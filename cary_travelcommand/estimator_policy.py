@@ -0,0 +1,279 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import threading
+import time
+from cary_travelcommand.travel_costs import RouteCostEstimator, EstimateQuery
+from cary_travelcommand.travel_calculations import TIMED_OUT
+
+
+class CircuitBreaker():
+    """
+    Trips open after failure_threshold failures in a row, after which
+    calls are refused until reset_after seconds have passed; then one
+    trial call is let through (half open), which closes the breaker if
+    it succeeds and opens it again if it fails
+    """
+
+    def __init__(self, failure_threshold=3, reset_after=60,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self._trial or self.clock() - self._opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """
+        Whether a call may be made now; claims the trial call when half
+        open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial \
+              and self.clock() - self._opened_at >= self.reset_after:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, succeeded):
+        with self._lock:
+            self._trial = False
+            if succeeded:
+                self.failures = 0
+                self._opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    if self._opened_at is None:
+                        logging.warning("circuit opened after {0} failures"
+                                        .format(self.failures))
+                    self._opened_at = self.clock()
+
+
+class LatencyWindow():
+    """
+    The latencies of the last window successful calls
+    """
+
+    def __init__(self, window=100):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, fraction):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) == 0:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class PolicyEstimator(RouteCostEstimator):
+    """
+    Tries an ordered list of interchangeable estimators (servicing the
+    same modes) for each query:
+
+      * estimators whose circuit breaker is open are skipped;
+      * if an estimator fails (raises or answers found=False) the next
+        one is tried at once;
+      * if it is still running after hedge_percentile of its recent
+        latencies (or hedge_delay seconds, until min_samples latencies
+        are known) the next one is started alongside, and the first
+        found estimate wins;
+      * after timeout seconds the query gives up with a timed_out
+        response, counting as a failure for the calls still running.
+
+    Breakers and latencies live on the instance, so a policy kept in
+    TRAVEL_CONFIG carries them from one action to the next.  Calls a
+    query stopped waiting for are left to finish on their thread; once
+    they hold half of the max_workers threads the pool is replaced, so
+    hung estimators can't starve later queries.
+    """
+
+    def __init__(self, estimators, timeout=None, hedge_percentile=0.95,
+                 hedge_delay=None, min_samples=20, failure_threshold=3,
+                 reset_after=60, max_workers=8, clock=time.monotonic):
+        self.estimators = list(estimators)
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_samples = min_samples
+        self.breakers = [CircuitBreaker(failure_threshold, reset_after, clock)
+                         for est in self.estimators]
+        self.latencies = [LatencyWindow() for est in self.estimators]
+        self.hedges = 0
+        self.failovers = 0
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._abandoned = set()
+
+    @property
+    def name(self):
+        return " / ".join(est.name for est in self.estimators)
+
+    @property
+    def travel_modes_serviced(self):
+        modes = []
+        for est in self.estimators:
+            modes.extend(mode for mode in est.travel_modes_serviced
+                         if mode not in modes)
+        return modes
+
+    def services(self, mode):
+        return any(est.services(mode) for est in self.estimators)
+
+    @property
+    def prices_roundtrips(self):
+        return all(est.prices_roundtrips for est in self.estimators)
+
+    def stats(self):
+        return dict(
+            hedges=self.hedges,
+            failovers=self.failovers,
+            estimators=[dict(name=est.name,
+                             state=breaker.state,
+                             failures=breaker.failures,
+                             p50=latencies.percentile(0.5),
+                             p95=latencies.percentile(0.95))
+                        for (est, breaker, latencies)
+                        in zip(self.estimators, self.breakers,
+                               self.latencies)])
+
+    def hedge_after(self, index):
+        """
+        Seconds to wait on estimator index before starting the next
+        """
+        if len(self.latencies[index]) >= self.min_samples:
+            return self.latencies[index].percentile(self.hedge_percentile)
+        return self.hedge_delay
+
+    def _call(self, index, query, settled):
+        started = time.monotonic()
+        try:
+            result = self.estimators[index].estimate(query)
+        except Exception as e:
+            logging.error(repr(e))
+            result = None
+        succeeded = result is not None and result.get('found', False)
+        if succeeded:
+            self.latencies[index].add(time.monotonic() - started)
+        self._settle(index, settled, succeeded)
+        return result
+
+    def _submit(self, index, query, settled):
+        with self._lock:
+            self._abandoned.difference_update(
+                [future for future in self._abandoned if future.done()])
+            if 2 * len(self._abandoned) >= self.max_workers:
+                logging.warning("{0} of {1} policy threads are stuck; "
+                                "starting a new pool".format(
+                                    len(self._abandoned), self.max_workers))
+                self._executor.shutdown(wait=False)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+                self._abandoned = set()
+            return self._executor.submit(self._call, index, query, settled)
+
+    def _abandon(self, futures):
+        # calls nobody waits for any more; they still hold their threads
+        with self._lock:
+            self._abandoned.update(future for future in futures
+                                   if not future.done())
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _settle(self, index, settled, succeeded):
+        # a call is counted once, whether it returns or is timed out
+        with settled['lock']:
+            if index in settled['indices']:
+                return
+            settled['indices'].add(index)
+        self.breakers[index].record(succeeded)
+
+    def estimate(self, query):
+        deadline = None if self.timeout is None \
+          else time.monotonic() + self.timeout
+        settled = dict(lock=threading.Lock(), indices=set())
+        remaining = list(range(len(self.estimators)))
+        running = {}
+
+        def start_next():
+            while len(remaining) > 0:
+                index = remaining.pop(0)
+                if self.breakers[index].allow():
+                    running[self._submit(index, query, settled)] = \
+                        (index, time.monotonic())
+                    return True
+            return False
+
+        start_next()
+        try:
+            return self._await(deadline, settled, remaining, running,
+                               start_next)
+        finally:
+            self._abandon(running)
+
+    def _await(self, deadline, settled, remaining, running, start_next):
+        result = self.error_response
+        while len(running) > 0:
+            waits = []
+            if deadline is not None:
+                waits.append(deadline - time.monotonic())
+            hedge_at = None
+            if len(remaining) > 0:
+                (index, started) = max(running.values(),
+                                       key=lambda entry: entry[1])
+                delay = self.hedge_after(index)
+                if delay is not None:
+                    hedge_at = started + delay
+                    waits.append(hedge_at - time.monotonic())
+            done, pending = wait(list(running),
+                                 timeout=max(0, min(waits))
+                                 if len(waits) > 0 else None,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                estimate = future.result()
+                if estimate is not None and estimate.get('found', False):
+                    return estimate
+                if estimate is not None:
+                    result = estimate
+            if len(done) > 0:
+                if len(running) == 0 and start_next():
+                    self._count("failovers")
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                for (index, started) in running.values():
+                    self._settle(index, settled, False)
+                return dict(TIMED_OUT)
+            if hedge_at is not None and time.monotonic() >= hedge_at \
+              and start_next():
+                self._count("hedges")
+        return result
+
+    def single_estimate(self, start, end, date):
+        return self.estimate(EstimateQuery(start, end, date))
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self.estimate(EstimateQuery(start, end, date_out, date_back))
@@ -0,0 +1,142 @@
+from importlib import import_module
+import json
+import logging
+import threading
+
+ENTRY_POINT_GROUP = "cary_travelcommand.estimators"
+
+# name -> "module:attribute" of a callable returning an estimator; the
+# module is only imported when an estimator of that name is first made
+BUILTIN_ESTIMATORS = {
+    "qpx": "cary_travelcommand.travel_costs:QPXCostEstimator",
+    "fake_qpx": "cary_travelcommand.travel_costs:make_test_estimator",
+    "caching": "cary_travelcommand.estimator_wrappers:CachingEstimator",
+    "coalescing": "cary_travelcommand.estimator_wrappers:CoalescingEstimator",
+    "policy": "cary_travelcommand.estimator_policy:PolicyEstimator",
+    "recording": "cary_travelcommand.replay_estimator:RecordingEstimator",
+    "replay": "cary_travelcommand.replay_estimator:ReplayEstimator",
+    "rail": "cary_travelcommand.rail_fares:RailFareEstimator"
+    }
+
+
+def import_object(path):
+    """
+    The object named by "module:attribute"
+    """
+    module_name, _, attribute = path.partition(":")
+    obj = import_module(module_name)
+    for part in attribute.split(".") if attribute else []:
+        obj = getattr(obj, part)
+    return obj
+
+
+def entry_point_factories(group=ENTRY_POINT_GROUP):
+    """
+    {name: entry point} for estimators other packages provide
+    """
+    from importlib.metadata import entry_points
+    points = entry_points()
+    if hasattr(points, "select"):
+        points = points.select(group=group)
+    else:
+        points = points.get(group, [])
+    return {point.name: point for point in points}
+
+
+class EstimatorRegistry():
+    """
+    Makes estimators from specs, so TRAVEL_CONFIG can name the
+    estimators it wants without importing them.  A spec is one of
+
+      * an estimator, used as it is;
+      * a registered name ("qpx") or "module:attribute" path of a
+        callable taking no arguments;
+      * a dict {"type": name or path, **keyword arguments}, where the
+        "estimator" or "estimators" arguments may be specs themselves.
+
+    Names are the built in ones, any registered with register(), and
+    those installed under the cary_travelcommand.estimators entry point
+    group (only looked up when a name isn't otherwise known).  Each
+    distinct spec makes one estimator, reused by every action, so
+    caches and circuit breakers persist between messages.
+    """
+
+    def __init__(self, factories=BUILTIN_ESTIMATORS,
+                 entry_point_group=ENTRY_POINT_GROUP):
+        self._lock = threading.RLock()
+        self._factories = dict(factories)
+        self._entry_point_group = entry_point_group
+        self._entry_points = None
+        self._instances = {}
+
+    def register(self, name, factory):
+        """
+        Adds a named estimator; factory is a callable or the
+        "module:attribute" path of one
+        """
+        with self._lock:
+            self._factories[name] = factory
+
+    def factory(self, name):
+        with self._lock:
+            factory = self._factories.get(name)
+            if factory is None and ":" not in name:
+                if self._entry_points is None:
+                    self._entry_points = entry_point_factories(
+                        self._entry_point_group)
+                if name not in self._entry_points:
+                    raise KeyError("no estimator named {0}".format(name))
+                factory = self._entry_points[name].load()
+            elif factory is None:
+                factory = name
+            if isinstance(factory, str):
+                logging.debug("importing estimator {0}".format(factory))
+                factory = import_object(factory)
+            self._factories[name] = factory
+            return factory
+
+    def create(self, spec):
+        """
+        A new estimator for the spec
+        """
+        if isinstance(spec, str):
+            return self.factory(spec)()
+        if isinstance(spec, dict):
+            arguments = dict(spec)
+            factory = self.factory(arguments.pop("type"))
+            if "estimator" in arguments:
+                arguments["estimator"] = self.estimator(arguments["estimator"])
+            if "estimators" in arguments:
+                arguments["estimators"] = self.estimators(
+                    arguments["estimators"])
+            return factory(**arguments)
+        return spec
+
+    def estimator(self, spec):
+        """
+        The shared estimator for the spec
+        """
+        if not isinstance(spec, (str, dict)):
+            return spec
+        key = json.dumps(spec, sort_keys=True, default=repr)
+        with self._lock:
+            if key not in self._instances:
+                self._instances[key] = self.create(spec)
+            return self._instances[key]
+
+    def estimators(self, specs):
+        return [self.estimator(spec) for spec in specs]
+
+    def clear(self):
+        with self._lock:
+            self._instances.clear()
+
+
+REGISTRY = EstimatorRegistry()
+
+
+def shared_estimators(specs):
+    """
+    The process-wide estimators for a list of specs
+    """
+    return REGISTRY.estimators(specs)
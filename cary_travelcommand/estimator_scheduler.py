@@ -0,0 +1,231 @@
+from collections import deque
+from concurrent.futures import Future
+import datetime
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from cary_travelcommand.travel_costs import EstimateQuery
+from cary_travelcommand.estimator_wrappers import EstimatorWrapper
+
+INTERACTIVE = 0
+BULK = 1
+
+QUOTA_EXHAUSTED = dict(found=False, quota_exhausted=True)
+
+
+class TokenBucket():
+    """
+    Allows rate calls a second on average, in bursts of up to capacity.
+    Not locked itself; the scheduler only touches it under its own lock.
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """
+        Seconds until a call may be made
+        """
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class DailyBudget():
+    """
+    Counts calls against a daily limit (by local date), kept in an
+    sqlite file if one is given so the count survives restarts and is
+    shared by every process using the file
+    """
+
+    def __init__(self, limit, filename=None, clock=time.time):
+        self.limit = limit
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename or ":memory:",
+                                           check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS budget ("
+            "day TEXT PRIMARY KEY, used INTEGER)")
+        self._connection.commit()
+
+    def today(self):
+        return datetime.date.fromtimestamp(self.clock()).isoformat()
+
+    def used(self):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT used FROM budget WHERE day = ?",
+                (self.today(),)).fetchone()
+        return row[0] if row is not None else 0
+
+    def remaining(self):
+        return max(0, self.limit - self.used())
+
+    def spend(self):
+        """
+        Counts one call if the budget allows it; returns whether it did
+        """
+        day = self.today()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO budget VALUES (?, 0)", (day,))
+            spent = self._connection.execute(
+                "UPDATE budget SET used = used + 1 "
+                "WHERE day = ? AND used < ?", (day, self.limit)).rowcount
+            self._connection.execute("DELETE FROM budget WHERE day != ?",
+                                     (day,))
+            self._connection.commit()
+        return spent == 1
+
+
+class QuotaScheduler():
+    """
+    Queues calls to an estimator and releases them no faster than
+    rate a second (bursts of up to burst), interactive calls ahead of
+    bulk ones.  With daily_limit, calls beyond that many a day are
+    answered with QUOTA_EXHAUSTED rather than sent; budget_filename
+    keeps the day's count across restarts.
+
+    Use the interactive and bulk views as the estimators themselves;
+    stats() reports queue depth and recent waits for each priority.
+    """
+
+    def __init__(self, estimator, rate=1.0, burst=1, daily_limit=None,
+                 budget_filename=None, workers=1, clock=time.monotonic,
+                 wall_clock=time.time):
+        self.estimator = estimator
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.budget = DailyBudget(daily_limit, budget_filename, wall_clock) \
+          if daily_limit is not None else None
+        self.workers = workers
+        self.clock = clock
+        self.dispatched = 0
+        self.rejected = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._waits = {INTERACTIVE: deque(maxlen=100),
+                       BULK: deque(maxlen=100)}
+        self.interactive = ScheduledEstimator(self, INTERACTIVE)
+        self.bulk = ScheduledEstimator(self, BULK)
+
+    def submit(self, query, priority=INTERACTIVE):
+        """
+        A Future for the estimate of query
+        """
+        future = Future()
+        with self._condition:
+            heapq.heappush(self._queue, (priority, next(self._sequence),
+                                         self.clock(), query, future))
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return future
+
+    def _next(self):
+        """
+        Waits for the next call allowed to go ahead, returning it and
+        whether the daily budget allowed it
+        """
+        with self._condition:
+            while True:
+                if len(self._queue) == 0:
+                    self._condition.wait()
+                    continue
+                if self.budget is not None and self.budget.remaining() == 0:
+                    return heapq.heappop(self._queue), False
+                delay = self.bucket.delay()
+                if delay > 0:
+                    # woken early by new arrivals, which may outrank
+                    # the call at the head of the queue
+                    self._condition.wait(delay)
+                    continue
+                self.bucket.take()
+                return heapq.heappop(self._queue), True
+
+    def _work(self):
+        while True:
+            (priority, sequence, queued_at, query, future), allowed = \
+              self._next()
+            if allowed and self.budget is not None:
+                allowed = self.budget.spend()
+            with self._condition:
+                self._waits[priority].append(self.clock() - queued_at)
+                if allowed:
+                    self.dispatched += 1
+                else:
+                    self.rejected += 1
+            if not future.set_running_or_notify_cancel():
+                continue
+            if not allowed:
+                logging.warning("daily estimate budget exhausted")
+                future.set_result(dict(QUOTA_EXHAUSTED))
+                continue
+            try:
+                future.set_result(self.estimator.estimate(query))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self):
+        with self._condition:
+            def waits(priority):
+                recent = list(self._waits[priority])
+                return dict(
+                    queued=len([entry for entry in self._queue
+                                if entry[0] == priority]),
+                    mean_wait=sum(recent) / len(recent) if recent else None,
+                    max_wait=max(recent) if recent else None)
+            return dict(
+                queue_depth=len(self._queue),
+                interactive=waits(INTERACTIVE),
+                bulk=waits(BULK),
+                dispatched=self.dispatched,
+                rejected=self.rejected,
+                budget_remaining=self.budget.remaining()
+                if self.budget is not None else None)
+
+
+class ScheduledEstimator(EstimatorWrapper):
+    """
+    The scheduler's estimator seen at one priority
+    """
+
+    def __init__(self, scheduler, priority):
+        super().__init__(scheduler.estimator)
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def estimate(self, query):
+        return self.scheduler.submit(query, self.priority).result()
+
+    def single_estimate(self, start, end, date):
+        return self.estimate(EstimateQuery(start, end, date))
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self.estimate(EstimateQuery(start, end, date_out, date_back))
+
+    def batch_estimate(self, queries):
+        # queue them all before waiting on any
+        futures = [self.scheduler.submit(query, self.priority)
+                   for query in queries]
+        return [future.result() for future in futures]
@@ -0,0 +1,349 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
+import json
+import logging
+import sqlite3
+import threading
+import time
+from cary_travelcommand.travel_costs import RouteCostEstimator
+
+
+class EstimatorWrapper(RouteCostEstimator):
+    """
+    Base for estimators layered over another; by default everything
+    is passed straight through to the wrapped estimator
+    """
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+
+    @property
+    def name(self):
+        return self.estimator.name
+
+    @property
+    def travel_modes_serviced(self):
+        return self.estimator.travel_modes_serviced
+
+    def services(self, mode):
+        return self.estimator.services(mode)
+
+    @property
+    def error_response(self):
+        return self.estimator.error_response
+
+    @property
+    def prices_roundtrips(self):
+        return self.estimator.prices_roundtrips
+
+    def request_key(self, start, end, date, date_back=None):
+        return self.estimator.request_key(start, end, date, date_back)
+
+    def single_estimate(self, start, end, date):
+        return self.estimator.single_estimate(start, end, date)
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self.estimator.roundtrip_estimate(start, end,
+                                                 date_out, date_back)
+
+    def batch_estimate(self, queries):
+        return self.estimator.batch_estimate(queries)
+
+
+class CachingEstimator(EstimatorWrapper):
+    """
+    Caches successful estimates from the wrapped estimator, keyed on
+    its request_key (for QPX, the normalized request body), in an LRU
+    of maxsize entries and optionally an sqlite file holding at most
+    max_disk_entries.  Estimates are fresh for ttl seconds; with
+    stale_ttl > 0 an estimate up to stale_ttl seconds past that is
+    still returned immediately while a fresh one is fetched in the
+    background.
+    """
+
+    def __init__(self, estimator, ttl=3600, maxsize=1024,
+                 cache_filename=None, max_disk_entries=10000,
+                 stale_ttl=0, clock=time.time):
+        super().__init__(estimator)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_disk_entries = max_disk_entries
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()
+        self._refreshing = {}
+        self._connection = None
+        self._disk_entries = 0
+        if cache_filename is not None:
+            self._connection = sqlite3.connect(cache_filename,
+                                               check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS fares ("
+                "key TEXT PRIMARY KEY, stored_at REAL, result TEXT)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS fares_stored_at "
+                "ON fares (stored_at)")
+            self._connection.commit()
+            self._disk_entries = self._count_disk_entries()
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, stale_hits=self.stale_hits,
+                        misses=self.misses, size=len(self._memory),
+                        refreshing=len(self._refreshing))
+
+    def _count_disk_entries(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM fares").fetchone()[0]
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT stored_at, result FROM fares WHERE key = ?",
+                    (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+                    self._remember(key, entry)
+                    return entry
+        return None
+
+    def _store(self, key, result):
+        # the caller keeps result, so the cache holds its own copy
+        entry = (self.clock(), dict(result))
+        with self._lock:
+            self._remember(key, entry)
+            if self._connection is not None:
+                updated = self._connection.execute(
+                    "UPDATE fares SET stored_at = ?, result = ? "
+                    "WHERE key = ?",
+                    (entry[0], json.dumps(result), key)).rowcount
+                if updated == 0:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO fares VALUES (?, ?, ?)",
+                        (key, entry[0], json.dumps(result)))
+                    self._disk_entries += 1
+                if self._disk_entries > self.max_disk_entries:
+                    self._evict()
+                self._connection.commit()
+
+    def _evict(self):
+        # trims the oldest entries (through the stored_at index) to
+        # leave a tenth of the space free, so this only runs once in
+        # that many stores; other processes may share the file, so the
+        # entries are counted first
+        keep = self.max_disk_entries - self.max_disk_entries // 10
+        count = self._count_disk_entries()
+        if count > keep:
+            self._connection.execute(
+                "DELETE FROM fares WHERE key IN (SELECT key FROM fares "
+                "ORDER BY stored_at LIMIT ?)", (count - keep,))
+        self._disk_entries = min(count, keep)
+
+    def _fetch(self, key, estimate):
+        result = estimate()
+        if result is not None and result.get('found', False):
+            self._store(key, result)
+        return result
+
+    def _refresh(self, key, estimate):
+        try:
+            self._fetch(key, estimate)
+        except Exception as e:
+            logging.error(repr(e))
+        finally:
+            with self._lock:
+                del self._refreshing[key]
+
+    def _refresh_in_background(self, key, estimate):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            thread = threading.Thread(target=self._refresh,
+                                      args=(key, estimate), daemon=True)
+            self._refreshing[key] = thread
+        thread.start()
+
+    def wait_for_refreshes(self, timeout=None):
+        with self._lock:
+            threads = list(self._refreshing.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def _cached(self, key, estimate):
+        """
+        A copy of the usable cached result for key (starting a refresh
+        if it is stale), or None
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            age = self.clock() - entry[0]
+            if age <= self.ttl:
+                with self._lock:
+                    self.hits += 1
+                return dict(entry[1])
+            if age <= self.ttl + self.stale_ttl:
+                with self._lock:
+                    self.stale_hits += 1
+                self._refresh_in_background(key, estimate)
+                return dict(entry[1])
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def cached_estimate(self, key, estimate):
+        """
+        The cached result for key, or estimate() if there is none
+        """
+        result = self._cached(key, estimate)
+        if result is None:
+            result = self._fetch(key, estimate)
+        return result
+
+    def batch_estimate(self, queries):
+        """
+        Answers what it can from the cache and sends the misses on to
+        the wrapped estimator as one batch
+        """
+        keys = [self.request_key(*query) for query in queries]
+        result = [self._cached(key, partial(self.estimator.estimate, query))
+                  for (key, query) in zip(keys, queries)]
+        misses = [n for (n, cached) in enumerate(result) if cached is None]
+        estimates = self.estimator.batch_estimate([queries[n]
+                                                   for n in misses])
+        for (n, estimate) in zip(misses, estimates):
+            if estimate is not None and estimate.get('found', False):
+                self._store(keys[n], estimate)
+            result[n] = estimate
+        return result
+
+    def single_estimate(self, start, end, date):
+        return self.cached_estimate(
+            self.request_key(start, end, date),
+            lambda: self.estimator.single_estimate(start, end, date))
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self.cached_estimate(
+            self.request_key(start, end, date_out, date_back),
+            lambda: self.estimator.roundtrip_estimate(start, end,
+                                                      date_out, date_back))
+
+
+class SingleFlight():
+    """
+    Runs at most one call per key at a time; callers arriving while a
+    call for their key is outstanding wait for it and share its result
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def claim(self, key):
+        """
+        (True, a new Future) if the caller is to make the call for key,
+        which it must then settle, or (False, the Future of the call
+        already outstanding)
+        """
+        with self._lock:
+            pending = self._calls.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                return (False, pending)
+            pending = Future()
+            self._calls[key] = pending
+            return (True, pending)
+
+    def settle(self, key, pending, result=None, exception=None):
+        """
+        Hands the result of a claimed call to its waiters
+        """
+        with self._lock:
+            del self._calls[key]
+        if exception is not None:
+            pending.set_exception(exception)
+        else:
+            pending.set_result(result)
+
+    def do(self, key, call):
+        (leader, pending) = self.claim(key)
+        if leader:
+            try:
+                result = call()
+            except BaseException as e:
+                # waiters must hear of it however the call ended
+                self.settle(key, pending, exception=e)
+                raise
+            self.settle(key, pending, result)
+        return pending.result()
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+
+class CoalescingEstimator(EstimatorWrapper):
+    """
+    Shares one outstanding call between concurrent identical requests
+    (same request_key), so a burst of near-identical itineraries costs
+    one search per slice rather than one per sender.  Each caller gets
+    its own copy of the shared result.
+    """
+
+    def __init__(self, estimator):
+        super().__init__(estimator)
+        self.flights = SingleFlight()
+
+    @staticmethod
+    def _copy(result):
+        return dict(result) if result is not None else None
+
+    def _shared(self, key, estimate):
+        return self._copy(self.flights.do(key, estimate))
+
+    def single_estimate(self, start, end, date):
+        return self._shared(
+            self.request_key(start, end, date),
+            lambda: self.estimator.single_estimate(start, end, date))
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self._shared(
+            self.request_key(start, end, date_out, date_back),
+            lambda: self.estimator.roundtrip_estimate(start, end,
+                                                      date_out, date_back))
+
+    def batch_estimate(self, queries):
+        """
+        Joins the flights already outstanding for any of the queries
+        (or repeated within them), and sends the rest on to the wrapped
+        estimator as one batch
+        """
+        keys = [self.request_key(*query) for query in queries]
+        claims = [self.flights.claim(key) for key in keys]
+        leaders = [n for (n, (leader, pending)) in enumerate(claims)
+                   if leader]
+        try:
+            estimates = self.estimator.batch_estimate([queries[n]
+                                                       for n in leaders])
+        except BaseException as e:
+            for n in leaders:
+                self.flights.settle(keys[n], claims[n][1], exception=e)
+            raise
+        for (n, estimate) in zip(leaders, estimates):
+            self.flights.settle(keys[n], claims[n][1], estimate)
+        return [self._copy(pending.result()) for (leader, pending) in claims]
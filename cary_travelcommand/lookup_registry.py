@@ -0,0 +1,63 @@
+import os
+import threading
+import logging
+from cary_travelcommand.lookup_snapshot import is_snapshot, SnapshotLookup
+from cary_travelcommand.lookup_snapshot import SNAPSHOT_MODES
+
+
+class LookupRegistry():
+    """
+    Process-wide store of loaded RoutePointLookups, keyed on lookup
+    class and source file.  Each table is read once and then shared by
+    every action (and thread); it is only re-read when the source
+    file's modification time or size changes.  Shared lookups must be
+    treated as read-only.
+
+    The source may also be a compiled snapshot (see lookup_snapshot),
+    in which case it is memory-mapped rather than parsed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @staticmethod
+    def file_signature(filename):
+        stat = os.stat(filename)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def lookup(self, lookup_class, filename):
+        key = (lookup_class, os.path.abspath(filename))
+        signature = self.file_signature(filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != signature:
+                logging.info("loading {0} from {1}".format(
+                    lookup_class.__name__, filename))
+                entry = (signature, self.load(lookup_class, filename))
+                self._entries[key] = entry
+            return entry[1]
+
+    @staticmethod
+    def load(lookup_class, filename):
+        if is_snapshot(filename):
+            lookup = SnapshotLookup(filename)
+            if SNAPSHOT_MODES[lookup.mode] is not lookup_class:
+                raise ValueError("{0} is a {1} snapshot, not {2}".format(
+                    filename, lookup.mode, lookup_class.__name__))
+            return lookup
+        return lookup_class(filename)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+REGISTRY = LookupRegistry()
+
+
+def shared_lookup(lookup_class, filename):
+    """
+    Returns the shared lookup_class instance loaded from filename
+    """
+    return REGISTRY.lookup(lookup_class, filename)
@@ -0,0 +1,142 @@
+import argparse
+import mmap
+import os
+import struct
+from cary_travelcommand.travel_parser import RoutePointLookup
+from cary_travelcommand.travel_parser import AirportLookup, TrainStationLookup
+
+# Snapshot layout (all integers little-endian):
+#   header:  magic (8 bytes), mode (8 bytes, NUL padded), record count
+#   codes:   count * 3 bytes, sorted ASCII endpoint codes
+#   offsets: (count + 1) uint32 offsets into the string table
+#   strings: UTF-8 record fields separated by FIELD_SEPARATOR
+MAGIC = b"CTCSNAP1"
+HEADER = struct.Struct("<8s8sI")
+OFFSET = struct.Struct("<I")
+CODE_LENGTH = 3
+FIELDS = ("name", "city", "state", "country")
+FIELD_SEPARATOR = "\x1f"
+
+SNAPSHOT_MODES = {
+    "air": AirportLookup,
+    "rail": TrainStationLookup
+    }
+
+
+def is_snapshot(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def compile_snapshot(lookup, filename):
+    """
+    Writes the records of a loaded lookup to filename as a snapshot.
+    Only three-letter ASCII codes are kept, since those are the only
+    ones a route can name.  The file is written alongside and renamed
+    into place so processes with the old snapshot mapped are unaffected.
+    """
+    records = sorted((code, record) for (code, record) in lookup.records()
+                     if len(code) == CODE_LENGTH and code.isascii())
+    codes = b"".join(code.encode("ascii") for (code, record) in records)
+    strings = []
+    offsets = [0]
+    for (code, record) in records:
+        encoded = FIELD_SEPARATOR.join(
+            record.get(field) or '' for field in FIELDS).encode("utf-8")
+        strings.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, lookup.mode.encode("ascii"), len(records)))
+        f.write(codes)
+        f.write(b"".join(OFFSET.pack(offset) for offset in offsets))
+        f.write(b"".join(strings))
+    os.replace(temp_filename, filename)
+
+
+class SnapshotLookup(RoutePointLookup):
+    """
+    A read-only lookup served straight from a memory-mapped snapshot;
+    opening one costs no parsing, and worker processes mapping the
+    same file share a single page-cache copy
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, mode, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a lookup snapshot".format(filename))
+        self._mode = mode.rstrip(b"\0").decode("ascii")
+        self._codes_start = HEADER.size
+        self._offsets_start = self._codes_start + CODE_LENGTH * self._count
+        self._strings_start = self._offsets_start \
+          + OFFSET.size * (self._count + 1)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def __len__(self):
+        return self._count
+
+    def _code_at(self, index):
+        start = self._codes_start + CODE_LENGTH * index
+        return self._map[start:start + CODE_LENGTH]
+
+    def _index_of(self, endpoint):
+        try:
+            key = endpoint.encode("ascii")
+        except UnicodeEncodeError:
+            return None
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._code_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._code_at(low) == key:
+            return low
+        return None
+
+    def _record_at(self, index):
+        start, end = [OFFSET.unpack_from(self._map, self._offsets_start
+                                         + OFFSET.size * i)[0]
+                      for i in (index, index + 1)]
+        fields = self._map[self._strings_start + start:
+                           self._strings_start + end].decode("utf-8")
+        return dict(zip(FIELDS, fields.split(FIELD_SEPARATOR)))
+
+    def is_valid_endpoint(self, endpoint):
+        return self._index_of(endpoint) is not None
+
+    def record(self, endpoint):
+        index = self._index_of(endpoint)
+        return self._record_at(index) if index is not None else None
+
+    def records(self):
+        return ((self._code_at(i).decode("ascii"), self._record_at(i))
+                for i in range(self._count))
+
+    def codes(self):
+        return (self._code_at(i).decode("ascii") for i in range(self._count))
+
+    def per_diem_locstring(self, endpoint):
+        assert self.is_valid_endpoint(endpoint)
+        return SNAPSHOT_MODES[self.mode].locstring_for(self.record(endpoint))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compile an airport or station table into a snapshot")
+    parser.add_argument("mode", choices=sorted(SNAPSHOT_MODES))
+    parser.add_argument("source", help="airports CSV or ATOC LOC file")
+    parser.add_argument("snapshot", help="snapshot file to write")
+    args = parser.parse_args(argv)
+    compile_snapshot(SNAPSHOT_MODES[args.mode](args.source), args.snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+from importlib.util import find_spec
+
+# numpy is imported by the first vectorized costing (see numpy_module),
+# so deployments which never ask for one don't pay for importing it
+numpy = None
+
+# columns held for every day of a leg
+COLUMNS = ("lodging", "lodging_multiplier", "meals", "incidentals",
+           "mie_multiplier")
+# columns shown as whole dollars, as cost_for_day gives them
+WHOLE_DOLLARS = ("lodging", "meals", "incidentals")
+MULTIPLIERS = ("lodging_multiplier", "mie_multiplier")
+
+
+def vectorized_available():
+    return numpy is not None or find_spec("numpy") is not None
+
+
+def numpy_module():
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+    return numpy
+
+
+class DayCosts():
+    """
+    The per diem costs for every day of a leg as numpy columns, in
+    place of a list of cost_for_day dicts.  Totals are computed over
+    whole columns; indexing or iterating gives a DayView per day with
+    the same keys as the dicts (and writing a multiplier through a view
+    updates the column), so templates and the multiplier adjustments in
+    trip_costs_by_perdiems work on either form.
+    """
+
+    def __init__(self, days, columns):
+        self.days = list(days)
+        self.columns = columns
+
+    @classmethod
+    def for_seasons(cls, days, seasons):
+        """
+        The costs for days from a SeasonIndex, looking every day's
+        season up at once; None if some day falls outside every season
+        """
+        numpy = numpy_module()
+        days = list(days)
+        ordinals = numpy.array([day.toordinal() for day in days])
+        positions = numpy.searchsorted(numpy.array(seasons.starts),
+                                       ordinals, side='right') - 1
+        if len(days) == 0 or positions.min() < 0 \
+          or any(seasons.seasons[position] is None
+                 for position in set(positions.tolist())):
+            return None
+        columns = dict(
+            (column, numpy.array([float(season[column])
+                                  if season is not None else 0.0
+                                  for season in seasons.seasons])[positions])
+            for column in WHOLE_DOLLARS)
+        for column in MULTIPLIERS:
+            columns[column] = numpy.ones(len(days))
+        return cls(days, columns)
+
+    def __len__(self):
+        return len(self.days)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.days)
+        if not 0 <= index < len(self.days):
+            raise IndexError(index)
+        return DayView(self, index)
+
+    def __iter__(self):
+        return (DayView(self, index) for index in range(len(self.days)))
+
+    @property
+    def lodging_actual(self):
+        return self.columns['lodging'] * self.columns['lodging_multiplier']
+
+    @property
+    def mie_actual(self):
+        return (self.columns['meals'] + self.columns['incidentals']) \
+          * self.columns['mie_multiplier']
+
+    def lodging_total(self):
+        return float(self.lodging_actual.sum())
+
+    def mie_total(self):
+        return float(self.mie_actual.sum())
+
+
+class DayView():
+    """
+    One day of a DayCosts, read (and for multipliers written) like the
+    dict from cost_for_day
+    """
+
+    def __init__(self, costs, index):
+        self._costs = costs
+        self._index = index
+
+    def __getitem__(self, key):
+        if key == 'day':
+            return self._costs.days[self._index]
+        # actuals come from this day's entries, not whole columns, so
+        # reading every day stays linear in the days
+        columns = self._costs.columns
+        if key == 'lodging_actual':
+            return float(columns['lodging'][self._index]
+                         * columns['lodging_multiplier'][self._index])
+        if key == 'mie_actual':
+            return float((columns['meals'][self._index]
+                          + columns['incidentals'][self._index])
+                         * columns['mie_multiplier'][self._index])
+        value = float(columns[key][self._index])
+        return int(value) if key in WHOLE_DOLLARS else value
+
+    def __setitem__(self, key, value):
+        if key not in MULTIPLIERS:
+            raise KeyError("only multipliers can be set, not {0}".format(key))
+        self._costs.columns[key][self._index] = value
+
+    def __contains__(self, key):
+        return key in COLUMNS or key in ('day', 'lodging_actual',
+                                         'mie_actual')
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return ('day',) + COLUMNS + ('lodging_actual', 'mie_actual')
+
+    def __getattr__(self, key):
+        # so templates can write day.lodging as well as day['lodging']
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
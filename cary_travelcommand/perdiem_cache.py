@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+def normalized_location(location):
+    return " ".join(location.lower().split())
+
+
+class CachedPerdiemDatabase():
+    """
+    A stand-in for PerdiemDatabase whose perdiem_query results are kept
+    in an LRU cache (and optionally an sqlite file, so they survive a
+    restart).  Queries are keyed on the normalized location, the
+    threshold and the version (mtime and size) of the database files;
+    when either file changes the underlying PerdiemDatabase is reopened
+    and older cached results are discarded.  The database itself is
+    only opened (and, by default, PerdiemDatabase only imported) when
+    a query misses.
+    """
+
+    def __init__(self, locstrings_filename, database_filename,
+                 cache_filename=None, maxsize=1024,
+                 database_factory=None):
+        self.locstrings_filename = locstrings_filename
+        self.database_filename = database_filename
+        self.maxsize = maxsize
+        self.database_factory = database_factory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()
+        self._version = None
+        self._database = None
+        self._connection = None
+        if cache_filename is not None:
+            self._connection = sqlite3.connect(cache_filename,
+                                               check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS perdiem_queries ("
+                "version TEXT, location TEXT, threshold REAL, result TEXT, "
+                "PRIMARY KEY (version, location, threshold))")
+            self._connection.commit()
+
+    def version(self):
+        stats = [os.stat(filename) for filename
+                 in (self.locstrings_filename, self.database_filename)]
+        return ";".join("{0}:{1}".format(stat.st_mtime_ns, stat.st_size)
+                        for stat in stats)
+
+    def _check_version(self):
+        version = self.version()
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    logging.info("perdiem database changed; clearing cache")
+                self._version = version
+                self._database = None
+                self._memory.clear()
+                if self._connection is not None:
+                    self._connection.execute(
+                        "DELETE FROM perdiem_queries WHERE version != ?",
+                        (version,))
+                    self._connection.commit()
+            return version
+
+    @property
+    def database(self):
+        with self._lock:
+            if self._database is None:
+                factory = self.database_factory
+                if factory is None:
+                    from cary_perdiemcommand.perdiem_database \
+                      import PerdiemDatabase as factory
+                self._database = factory(
+                    self.locstrings_filename, self.database_filename)
+            return self._database
+
+    def stats(self):
+        return dict(hits=self.hits, disk_hits=self.disk_hits,
+                    misses=self.misses, size=len(self._memory))
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _cached(self, version, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT result FROM perdiem_queries WHERE version = ? "
+                    "AND location = ? AND threshold = ?",
+                    (version,) + key).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    result = json.loads(row[0])
+                    self._remember(key, result)
+                    return result
+        return None
+
+    def _store(self, version, key, result):
+        with self._lock:
+            if version != self._version:
+                return
+            self._remember(key, result)
+            if self._connection is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO perdiem_queries "
+                    "VALUES (?, ?, ?, ?)",
+                    (version,) + key + (json.dumps(result),))
+                self._connection.commit()
+
+    def perdiem_query(self, location, threshold=90):
+        version = self._check_version()
+        key = (normalized_location(location), threshold)
+        result = self._cached(version, key)
+        if result is None:
+            with self._lock:
+                self.misses += 1
+            result = self.database.perdiem_query(location,
+                                                 threshold=threshold)
+            self._store(version, key, result)
+        # the search text is the one thing that differs between
+        # queries sharing a normalized key
+        return dict(result, original_search_location=location)
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_perdiem_database(locstrings_filename, database_filename,
+                            cache_filename=None):
+    """
+    The process-wide CachedPerdiemDatabase for these files
+    """
+    key = (locstrings_filename, database_filename, cache_filename)
+    with _SHARED_LOCK:
+        if key not in _SHARED:
+            _SHARED[key] = CachedPerdiemDatabase(locstrings_filename,
+                                                 database_filename,
+                                                 cache_filename)
+        return _SHARED[key]
@@ -0,0 +1,144 @@
+from array import array
+from bisect import bisect_left
+import csv
+import logging
+import os
+import threading
+import time
+from cary_travelcommand.travel_costs import RouteCostEstimator
+
+
+def pair_key(origin, destination):
+    """
+    Two three-letter CRS codes packed into one integer, so that keys
+    sort by origin then destination
+    """
+    return int.from_bytes((origin + destination).encode("ascii"), "big")
+
+
+class RailFareTable():
+    """
+    Fares between pairs of stations from a CSV file of
+    origin,destination,fare rows (CRS codes; a header row is skipped),
+    held as a sorted array of packed pair keys alongside an array of
+    fares and searched by bisection.  Where a pair appears more than
+    once the cheapest fare is kept.  With symmetric, a fare given one
+    way also serves the journey back unless that has its own.
+    """
+
+    def __init__(self, filename, symmetric=True):
+        fares = {}
+        with open(filename, newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                pair = (row[0].strip().upper(), row[1].strip().upper())
+                try:
+                    fare = float(row[2])
+                except ValueError:
+                    # the header, or a row we can't use
+                    continue
+                if all(len(code) == 3 and code.isascii() for code in pair):
+                    fares[pair] = min(fare, fares.get(pair, fare))
+        if symmetric:
+            for ((origin, destination), fare) in list(fares.items()):
+                fares.setdefault((destination, origin), fare)
+        entries = sorted((pair_key(*pair), fare)
+                         for (pair, fare) in fares.items())
+        self.keys = array('Q', (key for (key, fare) in entries))
+        self.fares = array('d', (fare for (key, fare) in entries))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def fare(self, origin, destination):
+        """
+        The fare from origin to destination, or None
+        """
+        try:
+            key = pair_key(origin, destination)
+        except UnicodeEncodeError:
+            return None
+        index = bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            return self.fares[index]
+        return None
+
+
+# (filename, symmetric) -> (modification time, RailFareTable)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def shared_fare_table(filename, symmetric=True):
+    """
+    The process-wide RailFareTable for filename, loaded once and again
+    only when the file's modification time changes
+    """
+    key = (os.path.abspath(filename), symmetric)
+    mtime = os.stat(filename).st_mtime_ns
+    with _tables_lock:
+        entry = _tables.get(key)
+        if entry is None or entry[0] != mtime:
+            logging.info("loading rail fares from {0}".format(filename))
+            entry = (mtime, RailFareTable(filename, symmetric))
+            _tables[key] = entry
+        return entry[1]
+
+
+class RailFareEstimator(RouteCostEstimator):
+    """
+    Estimates rail fares from a local RailFareTable, with no network
+    access; the table is shared by the process (see shared_fare_table),
+    and the file is checked for changes at most every reload_interval
+    seconds.  Fares are multiplied by currency_rate, to give dollars
+    from a table in another currency.  Out and back legs are priced as
+    single journeys, each at its own fare, since the table has no
+    return fares to search for.
+    """
+
+    def __init__(self, fare_filename, currency_rate=1.0, symmetric=True,
+                 reload_interval=60, clock=time.monotonic):
+        self.fare_filename = fare_filename
+        self.currency_rate = currency_rate
+        self.symmetric = symmetric
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self._table = None
+        self._checked = None
+
+    @property
+    def name(self):
+        return "Rail fares"
+
+    @property
+    def travel_modes_serviced(self):
+        return ['rail']
+
+    @property
+    def prices_roundtrips(self):
+        return False
+
+    @property
+    def table(self):
+        now = self.clock()
+        if self._table is None or now - self._checked >= self.reload_interval:
+            self._table = shared_fare_table(self.fare_filename, self.symmetric)
+            self._checked = now
+        return self._table
+
+    def fare_response(self, fares):
+        if None in fares:
+            return self.error_response
+        total = sum(fares) * self.currency_rate
+        return dict(found=True, estimator=self.name, fares=[total],
+                    min_fare=total, median_fare=total, mean_fare=total,
+                    carriers=[])
+
+    def single_estimate(self, start, end, date):
+        return self.fare_response([self.table.fare(start, end)])
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        table = self.table
+        return self.fare_response([table.fare(start, end),
+                                   table.fare(end, start)])
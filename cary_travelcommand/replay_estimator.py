@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from cary_travelcommand.travel_costs import RouteCostEstimator, EstimateQuery
+from cary_travelcommand.estimator_wrappers import EstimatorWrapper
+
+
+def query_key(query):
+    """
+    The cassette key for an EstimateQuery; independent of estimator, so
+    a cassette recorded from one can be replayed in place of another
+    """
+    text = json.dumps([query.start, query.end, query.date.isoformat(),
+                       query.date_back.isoformat()
+                       if query.date_back is not None else None])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class RecordingEstimator(EstimatorWrapper):
+    """
+    Passes queries through to the wrapped estimator, saving each
+    response (and how long it took) to cassette_dir as
+    <query key>.json for a ReplayEstimator to serve later
+    """
+
+    def __init__(self, estimator, cassette_dir):
+        super().__init__(estimator)
+        self.cassette_dir = cassette_dir
+        os.makedirs(cassette_dir, exist_ok=True)
+
+    def record(self, query, response, latency):
+        filename = os.path.join(self.cassette_dir, query_key(query) + ".json")
+        temp_filename = "{0}.{1}.tmp".format(filename, threading.get_ident())
+        with open(temp_filename, "w") as f:
+            json.dump(dict(estimator=self.estimator.name,
+                           query=[query.start, query.end,
+                                  query.date.isoformat(),
+                                  query.date_back.isoformat()
+                                  if query.date_back is not None else None],
+                           latency=latency,
+                           response=response), f)
+        os.replace(temp_filename, filename)
+
+    def estimate(self, query):
+        started = time.monotonic()
+        response = self.estimator.estimate(query)
+        self.record(query, response, time.monotonic() - started)
+        return response
+
+    def single_estimate(self, start, end, date):
+        return self.estimate(EstimateQuery(start, end, date))
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self.estimate(EstimateQuery(start, end, date_out, date_back))
+
+    def batch_estimate(self, queries):
+        return [self.estimate(query) for query in queries]
+
+
+def fixed_latency(seconds):
+    return lambda rng, recorded: seconds
+
+
+def uniform_latency(low, high):
+    return lambda rng, recorded: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.5):
+    """
+    Long-tailed latencies around median seconds, much like real fare
+    searches
+    """
+    return lambda rng, recorded: rng.lognormvariate(math.log(median), sigma)
+
+
+def recorded_latency(scale=1.0):
+    """
+    The latency measured when the response was recorded
+    """
+    return lambda rng, recorded: (recorded or 0) * scale
+
+
+class ReplayEstimator(RouteCostEstimator):
+    """
+    Serves responses from a cassette written by RecordingEstimator.
+    The cassette's directory is indexed once; each response is read on
+    first use.  latency is a function (rng, recorded latency) ->
+    seconds to sleep before answering (see the *_latency helpers), and
+    failure_rate the chance of answering with the error response
+    instead, so concurrency, caching and failover can be exercised
+    offline.  Queries missing from the cassette get the error response.
+    """
+
+    def __init__(self, cassette_dir, latency=None, failure_rate=0.0,
+                 travel_modes_serviced=['air'], seed=None,
+                 sleep=time.sleep):
+        self.cassette_dir = cassette_dir
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._travel_modes_serviced = list(travel_modes_serviced)
+        self.sleep = sleep
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._responses = {}
+        self.index = {name[:-len(".json")]: os.path.join(cassette_dir, name)
+                      for name in os.listdir(cassette_dir)
+                      if name.endswith(".json")}
+
+    @property
+    def name(self):
+        return "Replay"
+
+    @property
+    def travel_modes_serviced(self):
+        return self._travel_modes_serviced
+
+    def __len__(self):
+        return len(self.index)
+
+    def _entry(self, key):
+        with self._lock:
+            if key not in self._responses:
+                with open(self.index[key]) as f:
+                    self._responses[key] = json.load(f)
+            return self._responses[key]
+
+    def _draw(self, recorded):
+        with self._lock:
+            delay = self.latency(self._random, recorded) \
+              if self.latency is not None else 0
+            failed = self._random.random() < self.failure_rate
+        return delay, failed
+
+    def estimate(self, query):
+        key = query_key(query)
+        if key not in self.index:
+            with self._lock:
+                self.misses += 1
+            logging.debug("no recorded response for {0}".format(query))
+            return self.error_response
+        entry = self._entry(key)
+        delay, failed = self._draw(entry.get('latency'))
+        if delay > 0:
+            self.sleep(delay)
+        with self._lock:
+            if failed:
+                self.failures += 1
+            else:
+                self.hits += 1
+        if failed or entry['response'] is None:
+            return self.error_response
+        return dict(entry['response'])
+
+    def single_estimate(self, start, end, date):
+        return self.estimate(EstimateQuery(start, end, date))
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        return self.estimate(EstimateQuery(start, end, date_out, date_back))
@@ -1,5 +1,14 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 import datetime
 import logging
+import os
+import threading
+import time
+from cary_travelcommand.travel_costs import EstimateQuery
+from cary_travelcommand.perdiem_arrays import DayCosts, vectorized_available
 
 def days_from_leg(leg):
     result = []
@@ -10,14 +19,55 @@ def days_from_leg(leg):
     return result
 
 
+def season_ordinal(date_string):
+    return datetime.datetime.strptime(date_string, "%m/%d/%Y").toordinal()
+
+
+class SeasonIndex():
+    """
+    A perdiem season table as sorted, non-overlapping intervals of
+    date ordinals, so finding a day's season is a bisect rather than a
+    scan.  Where seasons overlap the one listed first wins, just as it
+    did when the list was scanned in order.
+    """
+
+    def __init__(self, seasons):
+        intervals = [(season_ordinal(season['eff_date']),
+                      season_ordinal(season['exp_date']),
+                      season) for season in seasons]
+        bounds = sorted(set([start for (start, end, season) in intervals]
+                            + [end + 1 for (start, end, season) in intervals]))
+        self.starts = []
+        self.seasons = []
+        for bound in bounds:
+            covering = next((season for (start, end, season) in intervals
+                             if start <= bound <= end), None)
+            if len(self.seasons) > 0 and covering is self.seasons[-1]:
+                continue
+            self.starts.append(bound)
+            self.seasons.append(covering)
+
+    def season_for(self, day):
+        i = bisect_right(self.starts, day.toordinal()) - 1
+        return self.seasons[i] if i >= 0 else None
+
+
+@lru_cache(maxsize=256)
+def _cached_season_index(key):
+    return SeasonIndex([dict(items) for items in key])
+
+
+def season_index(seasons):
+    """
+    The SeasonIndex for a season table, built once per distinct table
+    (and so once per matched location)
+    """
+    return _cached_season_index(
+        tuple(tuple(sorted(season.items())) for season in seasons))
+
+
 def season_for_day(day, seasons):
-    cmpday = datetime.datetime(day.year, day.month, day.day)
-    for season in seasons:
-        eff_date = datetime.datetime.strptime(season['eff_date'], "%m/%d/%Y")
-        exp_date = datetime.datetime.strptime(season['exp_date'], "%m/%d/%Y")
-        if (cmpday >= eff_date) and (cmpday <= exp_date):
-            return season
-    return None
+    return season_index(seasons).season_for(day)
 
 
 def cost_for_day(day, season):
@@ -34,7 +84,11 @@ def cost_for_day(day, season):
         return None
 
 
-def perdiem_costs_by_query(days, query):
+def perdiem_costs_by_query(days, query, vectorized=False):
+    """
+    With vectorized the days' costs are a DayCosts rather than a list
+    of dicts (unless some day has no season)
+    """
 
     if not query['found']:
         result = dict(
@@ -44,37 +98,128 @@ def perdiem_costs_by_query(days, query):
             )
     else:
         topmatch = query['closest_matches'][0]
+        seasons = season_index(topmatch['seasons'])
+        dates = DayCosts.for_seasons(days, seasons) if vectorized else None
+        if dates is None:
+            dates = [cost_for_day(day, seasons.season_for(day))
+                     for day in days]
         result = dict(
             searched_location=query['original_search_location'],
             score=topmatch['score'],
             travel_cost=None,
             matched_location=topmatch['location'],
-            dates=[cost_for_day(
-                day,
-                season_for_day(day, topmatch['seasons']))
-                for day in days]
+            dates=dates
             )
     return result
 
 
+def season_spans(start, end, seasons):
+    """
+    [(first, last, season)] covering start to end (dates) as runs of
+    consecutive days in one season of a SeasonIndex, found by walking
+    the index's intervals rather than the days
+    """
+    first = start.toordinal()
+    last = end.toordinal()
+    i = bisect_right(seasons.starts, first) - 1
+    result = []
+    while first <= last:
+        season = seasons.seasons[i] if i >= 0 else None
+        run_end = min(last, seasons.starts[i + 1] - 1) \
+          if i + 1 < len(seasons.starts) else last
+        result.append((datetime.date.fromordinal(first),
+                       datetime.date.fromordinal(run_end),
+                       season))
+        first = run_end + 1
+        i += 1
+    return result
+
+
+def cost_for_span(first, last, season):
+    cost = cost_for_day(first, season)
+    if cost is not None:
+        cost['last_day'] = last
+        cost['days'] = (last - first).days + 1
+    return cost
+
+
+def same_rates(a, b):
+    return a is not None and b is not None \
+      and [a[key] for key in ('lodging', 'meals', 'incidentals')] \
+      == [b[key] for key in ('lodging', 'meals', 'incidentals')]
+
+
+def span_costs(start, end, seasons):
+    """
+    Costs for a stay as one entry per run of days at the same rates,
+    each like a cost_for_day entry plus its last_day and number of
+    days.  The first and last days are always entries of their own,
+    since their multipliers differ from the days between.
+    """
+    runs = []
+    for (first, last, season) in season_spans(start, end, seasons):
+        if len(runs) > 0 and same_rates(runs[-1][2], season):
+            runs[-1] = (runs[-1][0], last, runs[-1][2])
+        else:
+            runs.append((first, last, season))
+    one_day = datetime.timedelta(days=1)
+    if runs[0][0] < runs[0][1]:
+        (first, last, season) = runs[0]
+        runs[0:1] = [(first, first, season), (first + one_day, last, season)]
+    if runs[-1][0] < runs[-1][1]:
+        (first, last, season) = runs[-1]
+        runs[-1:] = [(first, last - one_day, season), (last, last, season)]
+    return [cost_for_span(first, last, season)
+            for (first, last, season) in runs]
+
+
+def perdiem_span_costs_by_query(start, end, query):
+    """
+    As perdiem_costs_by_query, but with the stay's costs from
+    span_costs, so a long stay costs as many entries as it has rate
+    changes rather than days
+    """
+    result = perdiem_costs_by_query([], query)
+    if query['found']:
+        result['dates'] = span_costs(
+            start, end, season_index(query['closest_matches'][0]['seasons']))
+    return result
+
+
 def perdiem_costs(days, location, pd_db):
     return perdiem_costs_by_query(days, pd_db.perdiem_query(location))
 
 
-def trip_costs_by_perdiems(trip, perdiems):
+def trip_costs_by_perdiems(trip, perdiems, vectorized=False, spans=False):
     """
     Takes a trip (list of legs, leg->(route, dates, staying_in))
     and a list of perdiem queries the
     same length as the number of legs,
-    returns [leg->(route,costs,staying_in)]
+    returns [leg->(route,costs,staying_in)]; vectorized (which needs
+    numpy) keeps each leg's daily costs as array columns, and spans
+    gives them per run of days at the same rates (see span_costs).
+    Spans are never vectorized, so with both spans wins.
     """
     assert(len(trip) == len(perdiems))
+    if spans and vectorized:
+        logging.debug("costing spans; vectorized is ignored")
+        vectorized = False
+    if vectorized and not vectorized_available():
+        raise ImportError("vectorized per diem costs need numpy")
+
+    def leg_costs(leg, perdiem):
+        if spans:
+            return perdiem_span_costs_by_query(leg['dates']['start'],
+                                               leg['dates']['end'],
+                                               perdiem)
+        return perdiem_costs_by_query(days_from_leg(leg), perdiem,
+                                      vectorized)
 
     def calc_legs(trip, perdiems):
-        return [dict(route=leg['route'],
+        return [dict(route=leg.get('route'),
                      dates=leg['dates'],
                      staying_in=leg['staying_in'],
-                     costs=perdiem_costs_by_query(days_from_leg(leg), perdiem))
+                     costs=leg_costs(leg, perdiem))
                      for (leg, perdiem) in zip(trip, perdiems)]
 
     def set_last_day_lodging(legs):
@@ -89,59 +234,397 @@ def trip_costs_by_perdiems(trip, perdiems):
             leg['costs']['dates'][date_index]['mie_multiplier'] = 0.75
 
     legs = calc_legs(trip, perdiems)
-    set_last_day_lodging(legs)
-    set_travel_mie(legs[0], 0)
-    set_travel_mie(legs[-1], -1)
+    if len(legs) > 0:
+        set_last_day_lodging(legs)
+        set_travel_mie(legs[0], 0)
+        set_travel_mie(legs[-1], -1)
     return legs
 
 
-def trip_costs(trip, pd_db, threshold):
-    perdiems = [pd_db.perdiem_query(leg['staying_in'], threshold=threshold) 
-                for leg in trip]
-    for leg_pd in perdiems:
+def unlocated_perdiem():
+    """
+    The perdiem query result for a leg with no location to look up
+    (its route's end isn't a known code)
+    """
+    return dict(found=False, closest_matches=[],
+                original_search_location=None)
+
+
+def trip_costs(trip, pd_db, threshold, vectorized=False, spans=False):
+    """
+    trip may be any iterable of legs (such as the generator from
+    iter_trip_legs); each leg's perdiem query is made as soon as the
+    leg arrives rather than after the whole trip has been parsed
+    """
+    legs = []
+    perdiems = []
+    for leg in trip:
+        if leg['staying_in'] is None:
+            leg_pd = unlocated_perdiem()
+        else:
+            leg_pd = pd_db.perdiem_query(leg['staying_in'],
+                                         threshold=threshold)
         logging.debug("Returned {0} matches, top being {1}".format(
             len(leg_pd['closest_matches']),
             leg_pd['closest_matches'][0] if leg_pd['found'] else "NO MATCH"
         ))
-    legs = trip_costs_by_perdiems(
-        trip,
-        perdiems
+        legs.append(leg)
+        perdiems.append(leg_pd)
+    return trip_costs_by_perdiems(
+        legs,
+        perdiems,
+        vectorized,
+        spans
         )
-    return legs
 
 
-def calculated_trip_costs(trip_costs, route_estimators=[]):
-    result = trip_costs.copy()
-    # walk through the trip and calculate
+def servicing_estimator(route, estimators):
+    """
+    The first estimator servicing the route's mode, or None
+    """
+    if route is None or route['mode'] is None:
+        return None
+    for est in estimators:
+        if est.services(route['mode']):
+            return est
+    return None
+
 
-    def route_costs(leg, estimators):
-        for est in estimators:
-            route = leg['route']
-            if est.services(route['mode']):
-                return est.single_estimate(route['start'],
-                                           route['end'],
-                                           leg['dates']['start'])
+def route_costs(leg, estimators):
+    """
+    Estimate from the first estimator servicing the leg's mode
+    """
+    est = servicing_estimator(leg['route'], estimators)
+    if est is None:
         return None
+    return est.single_estimate(leg['route']['start'],
+                               leg['route']['end'],
+                               leg['dates']['start'])
 
-    def set_route_cost(leg, estimators):
-        leg['costs']['travel_cost'] = route_costs(leg, estimators)
+
+def roundtrip_pairs(legs):
+    """
+    [(outbound index, return index)] for legs A->B later followed by
+    B->A in the same mode; a return leg pairs with the most recent
+    unpaired outbound leg, so nested out-and-backs pair correctly
+    """
+    unpaired = []
+    result = []
+    for (j, leg) in enumerate(legs):
+        route = leg['route']
+        if route is None or route['mode'] is None:
+            continue
+        match = None
+        for i in reversed(unpaired):
+            out = legs[i]['route']
+            if out['start'] == route['end'] and out['end'] == route['start'] \
+              and out['mode'] == route['mode']:
+                match = i
+                break
+        if match is not None:
+            unpaired.remove(match)
+            result.append((match, j))
+        else:
+            unpaired.append(j)
+    return result
+
+
+def apportioned_roundtrip(estimate, share):
+    """
+    One leg's share of a round trip estimate
+    """
+    result = dict(estimate,
+                  fares=[fare * share for fare in estimate['fares']],
+                  roundtrip=True)
+    for key in ('min_fare', 'median_fare', 'mean_fare'):
+        if result.get(key) is not None:
+            result[key] = result[key] * share
+    return result
+
+
+def single_requests(legs, indices, estimators):
+    result = []
+    for i in indices:
+        route = legs[i]['route']
+        est = servicing_estimator(route, estimators)
+        if est is not None:
+            result.append(((i,), est,
+                           EstimateQuery(route['start'], route['end'],
+                                         legs[i]['dates']['start'])))
+    return result
+
+
+def estimate_requests(legs, estimators, pair_roundtrips=True):
+    """
+    The searches needed for a trip, as [(leg indices, estimator,
+    EstimateQuery)]; out and back legs share one round trip query,
+    unless their estimator doesn't price round trips
+    """
+    pairs = dict(roundtrip_pairs(legs)) if pair_roundtrips else {}
+    returns = set(pairs.values())
+    requests = []
+    for (i, leg) in enumerate(legs):
+        if i in returns:
+            continue
+        if i not in pairs:
+            requests.extend(single_requests(legs, [i], estimators))
+            continue
+        route = leg['route']
+        est = servicing_estimator(route, estimators)
+        if est is not None and not est.prices_roundtrips:
+            requests.extend(single_requests(legs, [i, pairs[i]], estimators))
+        elif est is not None:
+            requests.append(((i, pairs[i]), est,
+                             EstimateQuery(route['start'], route['end'],
+                                           leg['dates']['start'],
+                                           legs[pairs[i]]['dates']['start'])))
+    return requests
+
+
+TIMED_OUT = dict(found=False, timed_out=True)
+
+# max_workers -> (the thread pool estimates of that many workers run
+# on, the calls left running on it past their deadline)
+_executors = {}
+_executors_lock = threading.Lock()
+# a forked child has none of the parent's pool threads
+os.register_at_fork(after_in_child=_executors.clear)
+
+
+def shared_executor(max_workers):
+    """
+    The process-wide pool of max_workers threads for estimates, kept
+    between trips so its threads, and the per-thread clients and
+    connections estimators keep on them, are reused.  Once calls which
+    overran their deadline hold half its threads, the pool is replaced
+    by a fresh one (the old threads finish their calls and exit), so
+    hung searches can't starve later trips.
+    """
+    with _executors_lock:
+        entry = _executors.get(max_workers)
+        if entry is not None:
+            stuck = entry[1]
+            stuck.difference_update([future for future in stuck
+                                     if future.done()])
+            if 2 * len(stuck) >= max_workers:
+                logging.warning("{0} of {1} estimate threads are stuck; "
+                                "starting a new pool".format(len(stuck),
+                                                             max_workers))
+                entry[0].shutdown(wait=False)
+                entry = None
+        if entry is None:
+            entry = (ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix="estimates-{0}".format(max_workers)),
+                     set())
+            _executors[max_workers] = entry
+        return entry[0]
+
+
+def _overran(max_workers, futures):
+    # notes calls still running on the shared pool after their deadline
+    with _executors_lock:
+        entry = _executors.get(max_workers)
+        if entry is not None:
+            entry[1].update(futures)
+
+
+def run_estimate_queries(queries, max_workers=1, deadline=None):
+    """
+    One estimate per (estimator, EstimateQuery), in order.  With
+    max_workers <= 1 the queries for each estimator go to its
+    batch_estimate together; otherwise each query runs on its own on a
+    thread pool shared by every trip (see shared_executor), and any not
+    back within deadline seconds are reported as TIMED_OUT (the call
+    itself is left to finish in the background, holding its thread),
+    so estimators must then be safe to call from several threads.
+    The deadline needs max_workers > 1; batches are waited for, so
+    estimators should bound their own calls (as QPX's timeout does).
+    """
+    result = [None] * len(queries)
+    if max_workers <= 1:
+        batches = OrderedDict()
+        for (n, (est, query)) in enumerate(queries):
+            batches.setdefault(id(est), (est, []))[1].append(n)
+        for (est, numbers) in batches.values():
+            estimates = est.batch_estimate([queries[n][1] for n in numbers])
+            for (n, estimate) in zip(numbers, estimates):
+                result[n] = estimate
+        return result
+
+    executor = shared_executor(max_workers)
+    futures = [executor.submit(est.estimate, query)
+               for (est, query) in queries]
+    wait(futures, timeout=deadline)
+    overran = []
+    for (n, future) in enumerate(futures):
+        if not future.done():
+            if not future.cancel():
+                overran.append(future)
+            result[n] = dict(TIMED_OUT)
+        elif future.exception() is not None:
+            logging.error(repr(future.exception()))
+            result[n] = dict(found=False)
+        else:
+            result[n] = future.result()
+    if len(overran) > 0:
+        _overran(max_workers, overran)
+    return result
+
+
+def run_estimate_requests(requests, max_workers=1, deadline=None):
+    """
+    One estimate per request from estimate_requests, in order (see
+    run_estimate_queries).  A query asked of the same estimator by
+    several requests is only made once, each request getting its own
+    copy of the answer.
+    """
+    unique = OrderedDict()
+    for (indices, est, query) in requests:
+        unique.setdefault((id(est), query), (est, query))
+    estimates = dict(zip(unique, run_estimate_queries(list(unique.values()),
+                                                      max_workers,
+                                                      deadline)))
+    result = []
+    answered = set()
+    for (indices, est, query) in requests:
+        key = (id(est), query)
+        estimate = estimates[key]
+        if key in answered and estimate is not None:
+            estimate = dict(estimate)
+        answered.add(key)
+        result.append(estimate)
+    return result
+
+
+def trips_route_estimates(trips, estimators, max_workers=1, deadline=None,
+                          pair_roundtrips=True):
+    """
+    One travel estimate per leg of each trip (a list of legs), with
+    the searches for every trip made together.  A round trip estimate
+    is split evenly between its two legs; if the round trip can't be
+    found (rather than timing out) each leg is then estimated on its
+    own, within whatever remains of the deadline.
+    """
+    started = time.monotonic()
+    # legs no estimator services (say a mistyped code) are left None
+    result = [[None] * len(legs) for legs in trips]
+    requests = [(t, request) for (t, legs) in enumerate(trips)
+                for request in estimate_requests(legs, estimators,
+                                                 pair_roundtrips)]
+    retry = []
+    estimates = run_estimate_requests([request for (t, request) in requests],
+                                      max_workers, deadline)
+    for ((t, (indices, est, query)), estimate) in zip(requests, estimates):
+        if len(indices) == 1:
+            result[t][indices[0]] = estimate
+        elif estimate is not None and estimate.get('found', False):
+            for i in indices:
+                result[t][i] = apportioned_roundtrip(estimate, 0.5)
+        elif estimate is not None and estimate.get('timed_out', False):
+            for i in indices:
+                result[t][i] = dict(TIMED_OUT)
+        else:
+            retry.extend((t, i) for i in indices)
+
+    if len(retry) > 0:
+        requests = [(t, request) for (t, i) in retry
+                    for request in single_requests(trips[t], [i], estimators)]
+        if deadline is not None:
+            deadline = max(0, deadline - (time.monotonic() - started))
+        estimates = run_estimate_requests(
+            [request for (t, request) in requests], max_workers, deadline)
+        for ((t, (indices, est, query)), estimate) in zip(requests,
+                                                         estimates):
+            result[t][indices[0]] = estimate
+    return result
+
+
+def route_estimates(legs, estimators, max_workers=1, deadline=None,
+                    pair_roundtrips=True):
+    """
+    One travel estimate per leg of a single trip (see
+    trips_route_estimates)
+    """
+    return trips_route_estimates([legs], estimators, max_workers, deadline,
+                                 pair_roundtrips)[0]
+
+
+def calculated_trip_costs(trip_costs, route_estimators=[], max_workers=1,
+                          deadline=None, pair_roundtrips=True,
+                          travel_costs=None):
+    """
+    Adds travel costs and actual perdiem amounts to each leg.  Out and
+    back legs (A->B ... B->A) are priced with a single round trip
+    search unless pair_roundtrips is False; with max_workers > 1 the
+    estimates are made concurrently (see run_estimate_queries),
+    bounded by deadline, otherwise they are batched per estimator.
+    travel_costs may give the legs' estimates where they have already
+    been made (as by trips_route_estimates).
+    """
+    result = trip_costs.copy()
+    # walk through the trip and calculate
 
     def set_actual_perdiem_costs(leg):
-        if leg['costs']['matched_location'] is not None:
-            for day in leg['costs']['dates']:
-                day['lodging_actual'] = day['lodging']\
-                  * day['lodging_multiplier']
-                day['mie_actual'] = (day['meals'] + day['incidentals']) \
-                  * day['mie_multiplier']
-
-    for leg in result:
-        set_route_cost(leg, route_estimators)
+        costs = leg['costs']
+        if costs['matched_location'] is None:
+            return
+        if isinstance(costs['dates'], DayCosts):
+            # worked out from the columns whenever they are read
+            return
+        # a span's actual costs are for all of its days
+        for day in costs['dates']:
+            day['lodging_actual'] = day['lodging']\
+              * day['lodging_multiplier'] * day.get('days', 1)
+            day['mie_actual'] = (day['meals'] + day['incidentals']) \
+              * day['mie_multiplier'] * day.get('days', 1)
+
+    if travel_costs is None:
+        travel_costs = route_estimates(result, route_estimators, max_workers,
+                                       deadline, pair_roundtrips)
+
+    for (leg, travel_cost) in zip(result, travel_costs):
+        leg['costs']['travel_cost'] = travel_cost
         set_actual_perdiem_costs(leg)
 
     return result
 
 
-def adjusted_trip_costs(trip, pd_db, route_estimators=[], threshold=90):
-    result = trip_costs(trip, pd_db, threshold=threshold)
-    return calculated_trip_costs(result, route_estimators)
+def inferred_routes(trip, endpoints):
+    """
+    Legs which only give a location ("5-7 May in Manchester") have no
+    route and so no fare; where the previous leg ended somewhere known,
+    route from there to the endpoint nearest the stay location (marked
+    'inferred') so the move can be priced.  endpoints is an
+    EndpointIndex.
+    """
+    previous = None
+    for leg in trip:
+        route = leg.get('route')
+        if route is None and previous is not None:
+            end = endpoints.nearest_endpoint(leg['staying_in'],
+                                             previous['mode'],
+                                             origin=previous['end'])
+            if end is not None and end != previous['end']:
+                route = dict(start=previous['end'],
+                             end=end,
+                             mode=previous['mode'],
+                             inferred=True)
+                leg = dict(leg, route=route)
+        if route is not None and route['mode'] is not None:
+            previous = route
+        yield leg
+
+
+def adjusted_trip_costs(trip, pd_db, route_estimators=[], threshold=90,
+                        endpoints=None, max_workers=1, deadline=None,
+                        pair_roundtrips=True, vectorized=False,
+                        spans=False):
+    if endpoints is not None:
+        trip = inferred_routes(trip, endpoints)
+    result = trip_costs(trip, pd_db, threshold=threshold,
+                        vectorized=vectorized, spans=spans)
+    return calculated_trip_costs(result, route_estimators,
+                                 max_workers=max_workers, deadline=deadline,
+                                 pair_roundtrips=pair_roundtrips)
     return result
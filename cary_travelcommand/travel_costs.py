@@ -1,10 +1,18 @@
 from abc import abstractmethod, ABCMeta, abstractproperty
-from apiclient.discovery import build
+from collections import namedtuple
+import hashlib
 import logging
 import json
+import threading
 from cary_travelcommand import __path__ as MODULE_PATH
 import os
 
+
+# one fare search; date_back is None for a single journey
+EstimateQuery = namedtuple('EstimateQuery', 'start end date date_back')
+EstimateQuery.__new__.__defaults__ = (None,)
+
+
 class RouteCostEstimator(metaclass=ABCMeta):
 
     @abstractmethod
@@ -36,29 +44,153 @@ class RouteCostEstimator(metaclass=ABCMeta):
     def error_response(self):
         return dict(found=False)
 
+    @property
+    def prices_roundtrips(self):
+        """
+        Whether out and back legs should be searched as one round trip;
+        estimators for which that is no cheaper than two single
+        journeys say no, so each leg keeps its own fare
+        """
+        return True
+
+    def request_key(self, start, end, date, date_back=None):
+        """
+        A string identifying a query to this estimator, used to key
+        caches; estimators which build a request body should key on
+        that instead
+        """
+        return json.dumps([self.name, start, end, date.isoformat(),
+                           date_back.isoformat() if date_back is not None
+                           else None])
+
+    def estimate(self, query):
+        """
+        Estimate for one EstimateQuery
+        """
+        if query.date_back is None:
+            return self.single_estimate(query.start, query.end, query.date)
+        return self.roundtrip_estimate(query.start, query.end,
+                                       query.date, query.date_back)
+
+    def batch_estimate(self, queries):
+        """
+        Estimates for a list of EstimateQuery, in the same order.
+        By default each query is sent on its own; estimators whose
+        service can take several searches in one request override this.
+        """
+        return [self.estimate(query) for query in queries]
+
+
+def fare_summary(response):
+    """
+    The fares (in dollars, one per trip option), their min, median
+    and mean, and the carriers flown, from a QPX search response in
+    one pass over its trip options
+    """
+    fares = []
+    carriers = set()
+    for option in response['trips'].get('tripOption', []):
+        fares.append(sum(float(price['saleTotal'][3:])
+                         for price in option['pricing']))
+        for trip_slice in option.get('slice', []):
+            for segment in trip_slice.get('segment', []):
+                carriers.add(segment['flight']['carrier'])
+    ordered = sorted(fares)
+    middle = len(ordered) // 2
+    return dict(
+        fares=fares,
+        min_fare=ordered[0] if fares else None,
+        median_fare=(ordered[middle] if len(ordered) % 2 == 1
+                     else (ordered[middle - 1] + ordered[middle]) / 2)
+        if fares else None,
+        mean_fare=sum(fares) / len(fares) if fares else None,
+        carriers=sorted(carriers))
+
 
 class QPXCostEstimator(RouteCostEstimator):
+    """
+    Estimates air fares with Google's QPX Express API.  Only a summary
+    of each response is kept; with keep_supplemental the whole response
+    is included as supplemental_data, and with supplemental_dir it is
+    written there instead and its filename given as supplemental_file.
+
+    Nothing about a search is stored on the estimator, so one instance
+    may serve several threads at once; each thread gets its own client
+    and keep-alive connection, built on first use.  A search taking
+    longer than timeout seconds on the socket fails (with the error
+    response) rather than holding up its thread.
+    """
 
-    def __init__(self, api_key, max_solutions=20):
-        self.service = build("qpxExpress", "v1", developerKey=api_key)
-        self.trips = self.service.trips()
+    def __init__(self, api_key, max_solutions=20, max_batch_size=50,
+                 keep_supplemental=False, supplemental_dir=None,
+                 timeout=30):
+        self.api_key = api_key
+        self.timeout = timeout
         self.max_solutions = max_solutions
+        self.max_batch_size = max_batch_size
+        self.keep_supplemental = keep_supplemental
+        self.supplemental_dir = supplemental_dir
+        self._discovery = None
+        self._discovery_lock = threading.Lock()
+        self._local = threading.local()
 
     @property
     def name(self):
         return "Google QPX"
 
+    def discovery_document(self, http):
+        """
+        The QPX Express discovery document, fetched over http
+        """
+        from apiclient.discovery import DISCOVERY_URI
+        from apiclient.errors import HttpError
+        uri = DISCOVERY_URI.format(api="qpxExpress", apiVersion="v1")
+        response, content = http.request(uri)
+        if response.status >= 400:
+            raise HttpError(response, content, uri=uri)
+        return content.decode("utf-8") if isinstance(content, bytes) \
+          else content
+
+    def build_service(self, http):
+        """
+        A client using the given connection; the discovery document is
+        only fetched for the first one and shared by the rest.  The
+        google API client is imported here rather than with the
+        module, as it is slow to import and many deployments never
+        search QPX.
+        """
+        from apiclient.discovery import build_from_document
+        with self._discovery_lock:
+            if self._discovery is None:
+                self._discovery = self.discovery_document(http)
+        return build_from_document(self._discovery, http=http,
+                                   developerKey=self.api_key)
+
+    @property
+    def service(self):
+        """
+        This thread's client
+        """
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            import httplib2
+            service = self.build_service(httplib2.Http(timeout=self.timeout))
+            self._local.service = service
+        return service
+
+    @property
+    def trips(self):
+        return self.service.trips()
+
     @property
     def travel_modes_serviced(self):
         return ['air']
 
     def execute_request(self, body):
-        self.last_request_body = body
-        self.last_request = self.trips.search(body=self.last_request_body)
-        self.last_response = self.last_request.execute()
+        return self.trips.search(body=body).execute()
 
-    def single_estimate(self, start, end, date):
-        body = {
+    def single_request_body(self, start, end, date):
+        return {
             "request": {
                 "slice": [
                     {
@@ -79,15 +211,17 @@ class QPXCostEstimator(RouteCostEstimator):
                         "refundable": False
                         }
             }
+
+    def single_estimate(self, start, end, date):
+        body = self.single_request_body(start, end, date)
         try:
-            self.execute_request(body)
-            return self.last_formatted_response()
+            return self.formatted_response(self.execute_request(body))
         except Exception as e:
             logging.error(repr(e))
             return self.error_response
 
-    def roundtrip_estimate(self, start, end, date_out, date_back):
-        body = {
+    def roundtrip_request_body(self, start, end, date_out, date_back):
+        return {
             "request": {
                 "slice": [
                     {
@@ -113,34 +247,89 @@ class QPXCostEstimator(RouteCostEstimator):
                         "refundable": False
                         }
             }
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        body = self.roundtrip_request_body(start, end, date_out, date_back)
         try:
-            self.execute_request(body)
-            return self.last_formatted_response()
+            return self.formatted_response(self.execute_request(body))
         except Exception as e:
             logging.error(repr(e))
             return self.error_response
 
-    def last_formatted_response(self):
+    def request_body(self, query):
+        if query.date_back is None:
+            return self.single_request_body(query.start, query.end,
+                                            query.date)
+        return self.roundtrip_request_body(query.start, query.end,
+                                           query.date, query.date_back)
+
+    def request_key(self, start, end, date, date_back=None):
+        body = self.request_body(EstimateQuery(start, end, date, date_back))
+        return json.dumps(body, sort_keys=True)
+
+    def batch_estimate(self, queries):
         """
-        We're mostly interested in aggregate data, so just return a
-        dictionary of
-        {found:bool, fares: [float in dollars], supplemental_data: {response}
+        Sends the searches as batch requests of up to max_batch_size,
+        so a whole trip shares one connection and one round of
+        authentication; a search that fails (or a batch that cannot
+        be sent) gives the error response for its queries
         """
-        def usd_to_float(usd):
-            return float(usd[3:])
+        result = [self.error_response for query in queries]
 
-        def option_price(option):
-            return sum([usd_to_float(price['saleTotal']) for price in option['pricing']])
+        def store(request_id, response, exception):
+            if exception is not None:
+                logging.error(repr(exception))
+            else:
+                try:
+                    result[int(request_id)] = self.formatted_response(response)
+                except Exception as e:
+                    logging.error(repr(e))
 
-        def option_prices(resp):
-            return [option_price(option) for option in resp['trips']['tripOption']]
+        service = self.service
+        trips = service.trips()
+        for first in range(0, len(queries), self.max_batch_size):
+            batch = service.new_batch_http_request(callback=store)
+            for index in range(first, min(first + self.max_batch_size,
+                                          len(queries))):
+                batch.add(trips.search(
+                    body=self.request_body(queries[index])),
+                    request_id=str(index))
+            try:
+                batch.execute()
+            except Exception as e:
+                logging.error(repr(e))
+        return result
+
+    def spilled_response(self, response):
+        """
+        Writes a response to supplemental_dir, returning the filename
+        """
+        text = json.dumps(response, sort_keys=True)
+        filename = os.path.join(
+            self.supplemental_dir,
+            hashlib.sha1(text.encode("utf-8")).hexdigest() + ".json")
+        with open(filename, "w") as f:
+            f.write(text)
+        return filename
 
-        return dict(
-            found=True,
-            estimator=self.name,
-            fares=option_prices(self.last_response),
-            supplemental_data=self.last_response.copy()
-            )
+    def formatted_response(self, response):
+        """
+        We're mostly interested in aggregate data, so just return a
+        dictionary of
+        {found:bool, fares: [float in dollars], min_fare, median_fare,
+         mean_fare, carriers: [code]} (see fare_summary); a response
+        with no trip options (no flights found) is the error response
+        """
+        summary = fare_summary(response)
+        if len(summary['fares']) == 0:
+            return self.error_response
+        result = dict(found=True, estimator=self.name)
+        result.update(summary)
+        if self.keep_supplemental:
+            result['supplemental_data'] = response
+        if self.supplemental_dir is not None:
+            result['supplemental_file'] = self.spilled_response(response)
+        return result
 
 
 class FakeQPXCostEstimator(QPXCostEstimator):
@@ -161,21 +350,22 @@ class FakeQPXCostEstimator(QPXCostEstimator):
     def name(self):
         return "FakeQPXCostEstimator"
 
+    def batch_estimate(self, queries):
+        return [self.estimate(query) for query in queries]
+
     def single_estimate(self, start, end, date):
         slice = self.single_request['request']['slice'][0]
         if slice['origin']==start and slice['destination'] == end :
-            self.last_response = self.single_response.copy()
-            return self.last_formatted_response()
+            return self.formatted_response(self.single_response)
         else:
             return self.error_response
 
     def roundtrip_estimate(self, start, end, date_out, date_back):
-        outslice = self.single_request['request']['slice'][0]
-        backslice = self.single_request['request']['slice'][0]
+        outslice = self.roundtrip_request['request']['slice'][0]
+        backslice = self.roundtrip_request['request']['slice'][1]
         if outslice['origin'] == start and outslice['destination'] == end \
           and backslice['origin'] == end and backslice['destination'] == start :
-            self.last_response = self.roundtrip_response.copy()
-            return self.last_formatted_response()
+            return self.formatted_response(self.roundtrip_response)
         else:
             return self.error_response
 
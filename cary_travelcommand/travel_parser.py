@@ -1,8 +1,13 @@
 from abc import abstractmethod, ABCMeta
+from collections import namedtuple
+from functools import lru_cache
 import csv
+import re
+import sys
 from pyparsing import *
 import datetime
 import logging
+from cary_travelcommand.endpoint_index import endpoint_index
 
 class RoutePointLookup(metaclass=ABCMeta):
     """
@@ -24,6 +29,25 @@ class RoutePointLookup(metaclass=ABCMeta):
     def per_diem_locstring(self, endpoint):
         return None
 
+    @abstractmethod
+    def records(self):
+        """
+        All (endpoint, record dict) pairs known to this lookup
+        """
+        return []
+
+    def record(self, endpoint):
+        """
+        The record dict for one endpoint, or None
+        """
+        return dict(self.records()).get(endpoint)
+
+    def codes(self):
+        """
+        Every endpoint known to this lookup
+        """
+        return (code for (code, record) in self.records())
+
     @property
     @abstractmethod
     def mode(self):
@@ -70,9 +94,18 @@ class AirportLookup(RoutePointLookup):
     def is_valid_endpoint(self, endpoint):
         return endpoint in self.airports
 
+    def records(self):
+        return self.airports.items()
+
+    def record(self, endpoint):
+        return self.airports.get(endpoint)
+
     def per_diem_locstring(self, endpoint):
         assert self.is_valid_endpoint(endpoint)
-        airport = self.airports[endpoint]
+        return self.locstring_for(self.airports[endpoint])
+
+    @staticmethod
+    def locstring_for(airport):
         if airport['country'] == 'USA':
             return ", ".join([airport['city'], airport['state'],
                               airport['country']])
@@ -83,7 +116,13 @@ class AirportLookup(RoutePointLookup):
 class TrainStationLookup(RoutePointLookup):
     # train stations--use LOC file from atoc, but there are
     # multiple records; we want the set of CRS codes
-    # Location records have length
+    # Location records have length 289 (without the line ending),
+    # start with an update marker and record type "L", and carry the
+    # CRS code in columns 56-58 and the description in 144-203
+    LOCATION_RECORD_LENGTH = 289
+    LOCATION_RECORD_TYPE = b"L"
+    DELETE_MARKER = b"D"
+    READ_SIZE = 1 << 20
 
     def __init__(self, filename=None, from_dict=None):
         self.stations = {}
@@ -100,23 +139,55 @@ class TrainStationLookup(RoutePointLookup):
         self.stations.update(d)
 
     def add_stations_from_file(self, filename):
-        with open(filename) as f:
-            for r in f.readlines():
-                if len(r) == 290:
-                    id = r[56:59].strip()
-                    city = r[144:204]
-                    if id != '':
-                        self.stations[id] = dict(city=city,
-                                                 name=city,
-                                                 country="United Kingdom")
+        """
+        Streams the LOC file in large binary chunks; lines are only
+        decoded once they are known to be location records, so memory
+        stays flat however large the national file is
+        """
+        country = "United Kingdom"
+        remainder = b""
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(self.READ_SIZE), b""):
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                for line in lines:
+                    self._add_station_record(line, country)
+        self._add_station_record(remainder, country)
+
+    def _add_station_record(self, line, country):
+        line = line.rstrip(b"\r")
+        if len(line) != self.LOCATION_RECORD_LENGTH \
+          or line[1:2] != self.LOCATION_RECORD_TYPE \
+          or line[0:1] == self.DELETE_MARKER:
+            return
+        id = line[56:59].strip().decode("ascii", "replace")
+        if id != '':
+            city = sys.intern(self.normalized_city(
+                line[144:204].decode("latin-1")))
+            self.stations[id] = dict(city=city,
+                                     name=city,
+                                     country=country)
+
+    @staticmethod
+    def normalized_city(city):
+        return " ".join(city.split()).title()
 
     def is_valid_endpoint(self, endpoint):
         return endpoint in self.stations
 
+    def records(self):
+        return self.stations.items()
+
+    def record(self, endpoint):
+        return self.stations.get(endpoint)
+
     def per_diem_locstring(self, endpoint):
         assert self.is_valid_endpoint(endpoint)
-        station = self.stations(endpoint)
-        return ", ".join(station.city, station.country)
+        return self.locstring_for(self.stations[endpoint])
+
+    @staticmethod
+    def locstring_for(station):
+        return ", ".join([station['city'], station['country']])
 
 
 TEST_AIRPORTS = dict(
@@ -151,6 +222,33 @@ TEST_TRAINS = dict(
 TestTrainLookup=TrainStationLookup(from_dict=TEST_TRAINS)
 
 
+def route_mode(lookups, start, end):
+    return endpoint_index(lookups).route_mode(start, end)
+
+
+def make_route(lookups, start, end):
+    """
+    The route dict for a leg; if either code is unknown to every
+    lookup, the closest known codes are listed under 'suggestions'
+    so the reply can ask "did you mean"
+    """
+    index = endpoint_index(lookups)
+    result = dict(start=start, end=end, mode=index.route_mode(start, end))
+    if result['mode'] is None:
+        suggestions = dict((code, index.suggestions(code))
+                           for code in (start, end) if code not in index)
+        if len(suggestions) > 0:
+            result['suggestions'] = suggestions
+    return result
+
+
+def staying_in_location(lookups, route):
+    for lookup in lookups:
+        if route['mode'] == lookup.mode:
+            return lookup.per_diem_locstring(route['end'])
+    return None
+
+
 ###
 # PyParsing code
 def route_parser(lookups):
@@ -165,55 +263,48 @@ def route_parser(lookups):
     route = loc.setResultsName("start")\
       + Optional(route_connector).suppress() + loc.setResultsName("end")
 
-    def route_mode(start, end):
-        for lookup in lookups:
-            if lookup.is_valid_route(start,end):
-                return lookup.mode
-
     route.setParseAction(lambda s, l, t:
-                             dict(
-                                 start=t.start,
-                                 end=t.end,
-                                 mode=route_mode(t.start, t.end)))
+                         make_route(lookups, t.start, t.end))
 
     return route
 
 
-def month_parser():
-    monthLookup = {
-        "jan": 1,
-        "january": 1,
-        "feb": 2,
-        "february": 2,
-        "mar": 3,
-        "march": 3,
-        "apr": 4,
-        "april": 4,
-        "may": 5,
-        "jun": 6,
-        "june": 6,
-        "jul": 7,
-        "july": 7,
-        "aug": 8,
-        "august": 8,
-        "sep": 9,
-        "september": 9,
-        "oct": 10,
-        "october": 10,
-        "nov": 11,
-        "november": 11,
-        "dec": 12,
-        "december": 12
-        }
+MONTH_LOOKUP = {
+    "jan": 1,
+    "january": 1,
+    "feb": 2,
+    "february": 2,
+    "mar": 3,
+    "march": 3,
+    "apr": 4,
+    "april": 4,
+    "may": 5,
+    "jun": 6,
+    "june": 6,
+    "jul": 7,
+    "july": 7,
+    "aug": 8,
+    "august": 8,
+    "sep": 9,
+    "september": 9,
+    "oct": 10,
+    "october": 10,
+    "nov": 11,
+    "november": 11,
+    "dec": 12,
+    "december": 12
+    }
+
 
+def month_parser():
     def monthNumToMonth(s, l, t):
         m = t[0].lower()
-        if m in monthLookup:
-            return monthLookup[m]
+        if m in MONTH_LOOKUP:
+            return MONTH_LOOKUP[m]
         else:
             raise TypeError
 
-    month = oneOf(list(monthLookup.keys()), caseless=True)
+    month = oneOf(list(MONTH_LOOKUP.keys()), caseless=True)
     month.setParseAction(monthNumToMonth)
     return month
 
@@ -258,9 +349,9 @@ def date_parser():
             raise e
 
     date_v1 = year.setResultsName("year") + \
-              Optional(datesep).suppress() + \
+              Optional(datesep.copy()).suppress() + \
               nummonth.setResultsName("month") + \
-              Optional(datesep).suppress() + \
+              Optional(datesep.copy()).suppress() + \
               day.setResultsName("day")
 
     date_v2 = day.setResultsName("day")\
@@ -322,12 +413,6 @@ def trip_leg_parser(lookups):
                         CaselessLiteral("in").suppress() +
                         anyloc.setResultsName("staying_in"))
 
-    def staying_in_location(route):
-        for lookup in lookups:
-            if route['mode'] == lookup.mode:
-                return lookup.per_diem_locstring(route['end'])
-        return None
-
     def legdict(s, l, t):
         result = {}
         if 'route' in t and t.route != '':
@@ -337,16 +422,271 @@ def trip_leg_parser(lookups):
         if 'staying_in' in t and t.staying_in != '':
             result['staying_in'] = t.staying_in
         else:
-            result['staying_in'] = staying_in_location(t.route)
+            result['staying_in'] = staying_in_location(lookups, t.route)
         return result
 
     trip_leg.setParseAction(legdict)
     return trip_leg
 
 
-def trip_parser(lookups):
-    ParserElement.setDefaultWhitespaceChars(" \t")
+def _line_whitespace(grammar, chars=" \t"):
+    """
+    Sets the whitespace every element of grammar skips to chars (by
+    default not newlines, so a leg can't run on to the next line),
+    leaving pyparsing's global default alone
+    """
+    seen = set()
+    elements = [grammar]
+    while len(elements) > 0:
+        element = elements.pop()
+        if id(element) in seen:
+            continue
+        seen.add(id(element))
+        if element.skipWhitespace:
+            element.setWhitespaceChars(chars)
+        elements.extend(getattr(element, "exprs", []))
+        if getattr(element, "expr", None) is not None:
+            elements.append(element.expr)
+    return grammar
+
+
+def _compiled(grammar):
+    # memoization keeps the date range alternatives from re-parsing the
+    # same prefixes; pyparsing only offers it for every grammar at once,
+    # so it is switched on when one of ours is first built rather than
+    # when the module is imported
+    ParserElement.enablePackrat()
+    _line_whitespace(grammar).streamline()
+    return grammar
+
+
+@lru_cache(maxsize=8)
+def _compiled_trip_parser(lookups):
     t = trip_leg_parser(lookups)
+    return _compiled(t + ZeroOrMore(LineEnd().suppress() + t))
+
+
+def trip_parser(lookups):
+    """
+    Returns the trip grammar for this set of lookups; the grammar is
+    compiled once per distinct lookup set and shared afterwards, so
+    lookups should not be replaced for every message
+    """
+    return _compiled_trip_parser(tuple(lookups))
+
+
+@lru_cache(maxsize=8)
+def _compiled_line_parser(lookups):
+    # a single leg which must account for the whole line, so trailing
+    # junk is reported rather than silently dropped
+    return _compiled(trip_leg_parser(lookups) + StringEnd())
+
+
+###
+# Regex fast path for the common leg forms, eg
+#   lhr->dub 4-8 aug 2015 staying in Kilkenny, Ireland
+#   2013/07/26-2013/07/27
+#   26 Jul 2013 to 27 Jul 2013
+# Lines it cannot classify are handed to the pyparsing grammar, so it
+# only needs to be strict, not complete.
+_MONTH = "(?i:" + "|".join(sorted(MONTH_LOOKUP, key=len, reverse=True)) \
+  + ")(?![A-Za-z])"
+_DAY = r"\d{1,2}(?!\d)"
+_YEAR = r"\d{4}(?!\d)"
+_SEP = r"(?:-|to(?![A-Za-z]))"
+
+_ROUTE = r"(?P<start>[A-Za-z]{3})(?![A-Za-z])[ \t]*(?:->|-)?[ \t]*" \
+  r"(?P<end>[A-Za-z]{3})(?![A-Za-z])"
+
+_RANGE_V2 = r"(?P<sd>{day})(?:[ \t]*(?P<sm>{month}))?[ \t]*(?:{sep}[ \t]*)?" \
+  r"(?:(?P<ed>{day})[ \t]*)?(?P<em>{month})(?:[ \t]*(?P<y>{year}))?"
+
+
+def _single_date(prefix):
+    return (r"(?:(?P<{p}d>{day})[ \t]*(?P<{p}m>{month})(?:[ \t]*(?P<{p}y>{year}))?"
+            r"|(?P<{p}ny>{year})[ \t]*[-/]?[ \t]*(?P<{p}nm>{day})"
+            r"[ \t]*[-/]?[ \t]*(?P<{p}nd>{day}))").replace("{p}", prefix)
+
+
+_RANGE_V1 = _single_date("from_") + r"(?:[ \t]*{sep}[ \t]*" + _single_date("to_") + ")?"
+
+_STAYING = r"(?:staying[ \t]+)?(?i:in)[ \t]+" \
+  r"(?P<stay>[A-Za-z,\-]+(?:[ \t]+[A-Za-z,\-]+)*)"
 
-    trip_parser = t + ZeroOrMore(LineEnd().suppress() + t)
-    return trip_parser
+def _expand(pattern):
+    for name, value in (("{day}", _DAY), ("{month}", _MONTH),
+                        ("{year}", _YEAR), ("{sep}", _SEP)):
+        pattern = pattern.replace(name, value)
+    return pattern
+
+_LEG_RE = re.compile(_expand(
+    r"^[ \t]*(?:" + _ROUTE + r"[ \t]*)?(?:" + _RANGE_V2 + "|" + _RANGE_V1 + ")"
+    r"(?:[ \t]+" + _STAYING + r")?[ \t]*$"))
+
+
+def _month_number(name):
+    return MONTH_LOOKUP[name.lower()]
+
+
+def _matched_date(g, prefix):
+    if g[prefix + 'd'] is not None:
+        month = _month_number(g[prefix + 'm'])
+        day = int(g[prefix + 'd'])
+        year = int(g[prefix + 'y']) if g[prefix + 'y'] is not None \
+          else year_guess_today(month, day)
+        return datetime.date(year, month, day)
+    else:
+        return datetime.date(int(g[prefix + 'ny']),
+                             int(g[prefix + 'nm']),
+                             int(g[prefix + 'nd']))
+
+
+def _matched_dates(g):
+    if g['em'] is not None:
+        end_month = _month_number(g['em'])
+        start_month = _month_number(g['sm']) if g['sm'] is not None \
+          else end_month
+        start_day = int(g['sd'])
+        end_day = int(g['ed']) if g['ed'] is not None else start_day
+        year = int(g['y']) if g['y'] is not None \
+          else year_guess_today(end_month, end_day)
+        return dict(start=datetime.date(year, start_month, start_day),
+                    end=datetime.date(year, end_month, end_day))
+    else:
+        start = _matched_date(g, 'from_')
+        end = _matched_date(g, 'to_') \
+          if g['to_d'] is not None or g['to_ny'] is not None else start
+        return dict(start=start, end=end)
+
+
+def fast_trip_leg(line, lookups):
+    """
+    Recognises a single leg line without pyparsing, returning the same
+    leg dict as trip_leg_parser or None if the line isn't one of the
+    canonical forms
+    """
+    m = _LEG_RE.match(line)
+    if m is None:
+        return None
+    g = m.groupdict()
+    if g['start'] is None and g['stay'] is None:
+        # let pyparsing report the missing route/location
+        return None
+    try:
+        result = {}
+        if g['start'] is not None:
+            start, end = g['start'].upper(), g['end'].upper()
+            result['route'] = make_route(lookups, start, end)
+        result['dates'] = _matched_dates(g)
+    except ValueError:
+        return None
+    if g['stay'] is not None:
+        result['staying_in'] = " ".join(g['stay'].split())
+    else:
+        result['staying_in'] = staying_in_location(lookups, result['route'])
+    return result
+
+
+PARSER_ENGINES = ("fast", "pyparsing")
+
+LegParseError = namedtuple('LegParseError', 'lineno col line message')
+
+
+def _ends_trip(line):
+    # a signature separator ("-- ") or a quoted reply
+    return line.rstrip() == '--' or line.lstrip().startswith('>')
+
+
+def trip_paragraphs(text):
+    """
+    The runs of consecutive non-blank lines of a message body, each as
+    a list of (1-based line number, line), up to any signature or
+    quoted reply
+    """
+    paragraph = []
+    for lineno, line in enumerate(text.splitlines(), start=1):
+        if _ends_trip(line):
+            break
+        if line.strip() == '':
+            if len(paragraph) > 0:
+                yield paragraph
+                paragraph = []
+        else:
+            paragraph.append((lineno, line))
+    if len(paragraph) > 0:
+        yield paragraph
+
+
+def _parsed_line(lineno, line, lookups, engine):
+    leg = fast_trip_leg(line, lookups) if engine == "fast" else None
+    if leg is not None:
+        return leg
+    try:
+        return _compiled_line_parser(lookups).parseString(line)[0]
+    except ParseException as e:
+        return LegParseError(lineno, e.col, line, e.msg)
+    except (TypeError, ValueError) as e:
+        # raised from parse actions, eg an impossible date or a leg
+        # with neither a route nor a location
+        logging.debug("unable to parse leg: {0}".format(repr(e)))
+        return LegParseError(lineno, 1, line, repr(e))
+
+
+def _parsed_paragraph(paragraph, lookups):
+    # the legs of a paragraph by the whole trip grammar, or None
+    text = "\n".join(line for (lineno, line) in paragraph)
+    try:
+        return list(trip_parser(lookups).parseString(text, parseAll=True))
+    except (ParseException, TypeError, ValueError):
+        return None
+
+
+def iter_trip_legs(text, lookups, engine="fast"):
+    """
+    Parses a message body one line at a time, yielding a leg dict for
+    each line understood and a LegParseError (1-based line and column)
+    for each line that isn't.  The legs are the first paragraph holding
+    any: parsing stops at the blank line after it, or at a signature or
+    quoted reply, so the rest of an email isn't reported as skipped.
+    The "fast" engine tries fast_trip_leg first and only falls back to
+    the pyparsing leg grammar for lines it can't classify, while the
+    "pyparsing" engine parses each paragraph with trip_parser, going
+    line by line only to find the lines it can't understand.
+    """
+    if engine not in PARSER_ENGINES:
+        raise ValueError("unknown parser engine {0}".format(engine))
+    lookups = tuple(lookups)
+    for paragraph in trip_paragraphs(text):
+        legs = _parsed_paragraph(paragraph, lookups) \
+          if engine == "pyparsing" else None
+        if legs is not None:
+            yield from legs
+            return
+        found = False
+        for lineno, line in paragraph:
+            item = _parsed_line(lineno, line, lookups, engine)
+            found = found or not isinstance(item, LegParseError)
+            yield item
+        if found:
+            return
+
+
+def legs_only(items, errors):
+    """
+    Passes legs from iter_trip_legs through, collecting any
+    LegParseErrors into the supplied list instead
+    """
+    for item in items:
+        if isinstance(item, LegParseError):
+            errors.append(item)
+        else:
+            yield item
+
+
+def parse_trip(text, lookups, engine="fast"):
+    """
+    Parses a whole message body, returning (legs, skipped lines)
+    """
+    errors = []
+    legs = list(legs_only(iter_trip_legs(text, lookups, engine), errors))
+    return legs, errors
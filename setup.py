@@ -45,7 +45,9 @@ setup(
         'cary-perdiemcommand'
         ],
 
-    extras_require={},
+    extras_require={
+        'vectorized': ['numpy']
+        },
 
     package_data={
         'cary_travelcommand': ['templates/*', 'fake_estimator/*']
@@ -54,5 +56,8 @@ setup(
     data_files=[],
 
     entry_points={
+        'console_scripts': [
+            'cary-travel-snapshot=cary_travelcommand.lookup_snapshot:main'
+            ]
             },
 )
@@ -0,0 +1,124 @@
+"""
+Measures what importing cary_travelcommand costs:
+
+    python import_benchmark.py [--runs N] [--baseline REF]
+
+prints the median cumulative import time of the package (from
+python -X importtime, with cary.carycommand imported first so only
+this package is counted), the median wall clock time of a cold
+'python -c "import cary_travelcommand"', and the slowest modules the
+package pulls in.  Heavy dependencies (the google API client, jinja2,
+the per diem database, numpy, pyparsing) should not appear; they are
+imported on first use.
+
+With --baseline, the package as of that git ref is measured the same
+way and both figures are printed side by side, so a change can be
+checked before and after.
+"""
+from statistics import median
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# modules only needed once a message is parsed, an estimator searches, a
+# reply is rendered or costs are vectorized
+DEFERRED_MODULES = ("apiclient", "googleapiclient", "httplib2", "jinja2",
+                    "cary_perdiemcommand", "numpy", "pyparsing")
+
+PACKAGE_IMPORT = "import cary.carycommand; import cary_travelcommand"
+
+
+def _run(statement, options=(), path=None, **kwargs):
+    # path, if given, is where cary_travelcommand is imported from
+    env = None if path is None \
+      else dict(os.environ, PYTHONPATH=path)
+    return subprocess.run([sys.executable] + list(options)
+                          + ["-c", statement],
+                          env=env, cwd=path, check=True, **kwargs)
+
+
+def import_times(statement=PACKAGE_IMPORT, path=None):
+    """
+    {module: cumulative microseconds} for the modules statement imports
+    """
+    stderr = _run(statement, ["-X", "importtime"], path,
+                  stderr=subprocess.PIPE).stderr.decode()
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def cold_start(statement="import cary_travelcommand", path=None):
+    """
+    Seconds for a fresh interpreter to run statement
+    """
+    started = time.perf_counter()
+    _run(statement, path=path)
+    return time.perf_counter() - started
+
+
+def measure(runs, path=None):
+    """
+    (median cumulative package import ms, median cold start ms, the
+    import times of the first run)
+    """
+    samples = [import_times(path=path) for run in range(runs)]
+    package = median(times["cary_travelcommand"] for times in samples)
+    cold = median(cold_start(path=path) for run in range(runs))
+    return (package / 1000, cold * 1000, samples[0])
+
+
+def checkout(ref, directory):
+    """
+    Extracts the package as of git ref into directory
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    archive = subprocess.run(["git", "archive", ref, "cary_travelcommand"],
+                             cwd=root, stdout=subprocess.PIPE,
+                             check=True).stdout
+    subprocess.run(["tar", "-x", "-C", directory], input=archive,
+                   check=True)
+    return directory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the cost of importing cary_travelcommand")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--baseline", metavar="REF",
+                        help="git ref to compare against")
+    args = parser.parse_args(argv)
+    (package, cold, times) = measure(args.runs)
+    if args.baseline is None:
+        print("import cary_travelcommand: {0:.0f} ms cumulative".format(
+            package))
+        print("cold start: {0:.0f} ms".format(cold))
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            (before, cold_before, unused) = measure(
+                args.runs, checkout(args.baseline, directory))
+        print("{0:>26}  {1:>8}  {2:>8}".format("", args.baseline, "now"))
+        print("{0:>26}  {1:5.0f} ms  {2:5.0f} ms".format(
+            "import cary_travelcommand", before, package))
+        print("{0:>26}  {1:5.0f} ms  {2:5.0f} ms".format(
+            "cold start", cold_before, cold))
+    deferred = [module for module in times
+                if module.split(".")[0] in DEFERRED_MODULES]
+    if deferred:
+        print("imported but should be deferred: " + " ".join(deferred))
+    print("slowest modules:")
+    for (module, cumulative) in sorted(times.items(),
+                                       key=lambda item: -item[1])[:10]:
+        print("  {0:8.1f} ms  {1}".format(cumulative / 1000, module))
+    return 1 if deferred else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
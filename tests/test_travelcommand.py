@@ -2,11 +2,41 @@ from pytest_bdd import scenario, given, then, parsers
 import os
 from cary_travelcommand.travel_parser import TestAirportLookup, TestTrainLookup, trip_leg_parser
 from cary_travelcommand.travel_parser import route_parser, AirportLookup, date_range_parser
+from cary_travelcommand.travel_parser import TrainStationLookup
+from cary_travelcommand.travel_parser import trip_parser, fast_trip_leg, parse_trip
+from cary_travelcommand.travel_parser import iter_trip_legs, LegParseError
+from pyparsing import ParserElement
+from cary_travelcommand.lookup_registry import LookupRegistry
+from cary_travelcommand.lookup_snapshot import compile_snapshot, SnapshotLookup
 from cary_travelcommand.travel_calculations import days_from_leg, perdiem_costs_by_query
 from cary_travelcommand.travel_calculations import calculated_trip_costs, trip_costs_by_perdiems
-from cary_travelcommand.travel_costs import make_test_estimator
-from cary_perdiemcommand.perdiem_database import PerdiemDatabase
+from cary_travelcommand.travel_calculations import inferred_routes, season_for_day, SeasonIndex
+from cary_travelcommand.travel_calculations import roundtrip_pairs, shared_executor
+from cary_travelcommand.travel_calculations import run_estimate_queries
+from cary_travelcommand.endpoint_index import endpoint_index, EndpointIndex
+from cary_travelcommand.perdiem_cache import CachedPerdiemDatabase
+from cary_travelcommand import perdiem_cache
+from cary_travelcommand.estimator_wrappers import CachingEstimator, CoalescingEstimator, SingleFlight
+from concurrent.futures import ThreadPoolExecutor
+from cary_travelcommand.travel_costs import make_test_estimator, RouteCostEstimator
+from cary_travelcommand.travel_costs import EstimateQuery, fare_summary, QPXCostEstimator
+from cary_travelcommand.estimator_policy import PolicyEstimator
+from cary_travelcommand.estimator_registry import EstimatorRegistry
+from cary_travelcommand.replay_estimator import RecordingEstimator, ReplayEstimator
+from cary_travelcommand.replay_estimator import fixed_latency
+from cary_travelcommand.estimator_scheduler import QuotaScheduler, BULK
+from cary_travelcommand.rail_fares import RailFareTable, RailFareEstimator, shared_fare_table
+from cary_travelcommand.perdiem_arrays import DayCosts
+from cary_travelcommand import lodgingcost_filter, miecost_filter, TravelAction
+from cary_travelcommand.bulk_costing import BulkTripCoster, bulk_trip_costs
+from cary_travelcommand.travel_calculations import adjusted_trip_costs
 import datetime
+import threading
+import time
+import json
+import pytest
+from cary_travelcommand import __path__ as MODULE_PATH
+from import_benchmark import import_times, PACKAGE_IMPORT, DEFERRED_MODULES
 
 
 @scenario('travelcommand.feature', 'check for date range parsing')
@@ -314,3 +344,997 @@ def check_test_estimator(fake_estimator):
         "DUB",
         datetime.date(2015, 8, 4))
     assert estimate['fares'][0] == 166.6
+
+
+@scenario('travelcommand.feature', 'check trip grammar is compiled once')
+def test_trip_parser_cache():
+    pass
+
+
+@given('a trip parser')
+def sample_trip_parser():
+    return trip_parser([TestAirportLookup, TestTrainLookup])
+
+
+@then('check the trip parser is reused')
+def check_trip_parser_reused(sample_trip_parser):
+    assert trip_parser([TestAirportLookup, TestTrainLookup]) is sample_trip_parser
+    assert trip_parser([TestTrainLookup]) is not sample_trip_parser
+    assert "\n" in ParserElement.DEFAULT_WHITE_CHARS
+    assert "\n" not in sample_trip_parser.whiteChars
+    assert ParserElement._packratEnabled
+
+
+@then('check a two leg trip parses')
+def check_two_leg_trip(sample_trip_parser):
+    trip = sample_trip_parser.parseString("lhr-dub 26-27 Jul 2013\ndub-lhr 27 Jul 2013")
+    assert len(trip) == 2
+    assert trip[1]['route']['start'] == 'DUB'
+    assert trip[1]['staying_in'] == 'London, United Kingdom'
+
+
+@scenario('travelcommand.feature', 'check fast leg parsing matches the grammar')
+def test_fast_leg_parser():
+    pass
+
+
+@then('check the fast parser gives the same leg')
+def check_fast_leg(trip_leg_test_parser, leg):
+    lookups = [TestAirportLookup, TestTrainLookup]
+    fast = fast_trip_leg(leg, lookups)
+    assert fast is not None
+    assert fast == trip_leg_test_parser.parseString(leg)[0]
+    assert parse_trip(leg, lookups, "fast") \
+      == parse_trip(leg, lookups, "pyparsing")
+
+
+@scenario('travelcommand.feature', 'check unparseable lines are skipped')
+def test_skipped_lines():
+    pass
+
+
+@given('a trip with a bad line')
+def trip_with_bad_line():
+    return "\n" \
+      "lhr->dub 26-27 Jul 2013\n" \
+      "lhr->dub 26 Jul 2013 staying in St. Louis\n" \
+      "dub->lhr 27 Jul 2013\n"
+
+
+@then('check the good legs are parsed and the bad line reported')
+def check_skipped_lines(trip_with_bad_line):
+    lookups = [TestAirportLookup, TestTrainLookup]
+    for engine in ["fast", "pyparsing"]:
+        items = list(iter_trip_legs(trip_with_bad_line, lookups, engine))
+        assert len(items) == 3
+        assert isinstance(items[1], LegParseError)
+        assert items[1].lineno == 3
+        assert items[1].col == 35
+        legs, skipped = parse_trip(trip_with_bad_line, lookups, engine)
+        assert [leg['route']['start'] for leg in legs] == ['LHR', 'DUB']
+        assert skipped == [items[1]]
+
+
+@scenario('travelcommand.feature', 'check a signature and quoted reply are not parsed')
+def test_trip_with_signature():
+    pass
+
+
+@given('a trip with a signature')
+def trip_with_signature():
+    return "Hi,\n" \
+      "\n" \
+      "lhr->dub 26-27 Jul 2013\n" \
+      "dub->lhr 27 Jul 2013\n" \
+      "\n" \
+      "Thanks,\n" \
+      "Bob\n" \
+      "> On Monday, Alice wrote:\n" \
+      "> lhr->dub 1 Aug 2013\n"
+
+
+@then('check only the legs are parsed')
+def check_trip_with_signature(trip_with_signature):
+    lookups = [TestAirportLookup, TestTrainLookup]
+    signed = "lhr->dub 26-27 Jul 2013\n-- \nBob Smith\nDublin office\n"
+    for engine in ["fast", "pyparsing"]:
+        legs, skipped = parse_trip(trip_with_signature, lookups, engine)
+        assert [leg['route']['start'] for leg in legs] == ['LHR', 'DUB']
+        # only the greeting, before the legs, is reported
+        assert [error.lineno for error in skipped] == [1]
+        legs, skipped = parse_trip(signed, lookups, engine)
+        assert len(legs) == 1 and skipped == []
+
+
+@scenario('travelcommand.feature', 'check shared lookups are reloaded only when their file changes')
+def test_lookup_registry():
+    pass
+
+
+@given('an airport file')
+def airport_file(tmpdir):
+    f = tmpdir.join("airports.csv")
+    f.write("code,city,state,country,name\nLHR,London,,United Kingdom,Heathrow\n")
+    return f
+
+
+@then('check the shared lookup is reused until the file changes')
+def check_lookup_registry(airport_file):
+    registry = LookupRegistry()
+    first = registry.lookup(AirportLookup, str(airport_file))
+    assert registry.lookup(AirportLookup, str(airport_file)) is first
+    airport_file.write("DUB,Dublin,,Ireland,Dublin\n", mode="a")
+    second = registry.lookup(AirportLookup, str(airport_file))
+    assert second is not first
+    assert second.is_valid_endpoint("DUB")
+
+
+@scenario('travelcommand.feature', 'check snapshot lookups match the airport table')
+def test_snapshot_lookup():
+    pass
+
+
+@given('a compiled airport snapshot')
+def airport_snapshot(airport_lookup, tmpdir):
+    filename = str(tmpdir.join("airports.snap"))
+    compile_snapshot(airport_lookup, filename)
+    return SnapshotLookup(filename)
+
+
+@then('check the snapshot agrees for <identifier>')
+def check_snapshot_lookup(airport_lookup, airport_snapshot, identifier):
+    assert airport_snapshot.mode == "air"
+    assert airport_snapshot.is_valid_endpoint(identifier) \
+      == airport_lookup.is_valid_endpoint(identifier)
+    if airport_lookup.is_valid_endpoint(identifier):
+        assert airport_snapshot.per_diem_locstring(identifier) \
+          == airport_lookup.per_diem_locstring(identifier)
+    # an index resolves codes through the snapshot, copying nothing
+    index = EndpointIndex([airport_snapshot])
+    table_index = EndpointIndex([airport_lookup])
+    assert index.modes(identifier) == table_index.modes(identifier)
+    assert index.entries(identifier) == table_index.entries(identifier)
+    assert index._cities is None
+    assert index.suggestions(identifier) == table_index.suggestions(identifier)
+
+
+def loc_record(marker, record_type, crs, description):
+    record = marker + record_type + " " * 54 + crs.ljust(3) \
+      + " " * 85 + description.ljust(60)
+    return record.ljust(289) + "\r\n"
+
+
+@scenario('travelcommand.feature', 'check station lookup from an ATOC location file')
+def test_station_lookup():
+    pass
+
+
+@given('a station location file')
+def station_file(tmpdir):
+    f = tmpdir.join("locations.txt")
+    f.write("/!! comment line\r\n"
+            + loc_record("R", "L", "KGX", "LONDON   KINGS CROSS")
+            + loc_record("R", "L", "CBG", "CAMBRIDGE")
+            + loc_record("R", "A", "OXF", "OXFORD")
+            + loc_record("D", "L", "PAD", "LONDON PADDINGTON"))
+    return f
+
+
+@then('check the stations are loaded with normalized cities')
+def check_station_file(station_file):
+    lookup = TrainStationLookup(str(station_file))
+    assert sorted(lookup.stations.keys()) == ['CBG', 'KGX']
+    assert lookup.per_diem_locstring('KGX') == 'London Kings Cross, United Kingdom'
+    leg = fast_trip_leg("kgx-cbg 26-27 Jul 2013", [TestAirportLookup, lookup])
+    assert leg['route']['mode'] == 'rail'
+    assert leg['staying_in'] == 'Cambridge, United Kingdom'
+
+
+@scenario('travelcommand.feature', 'check mistyped codes get suggestions')
+def test_route_suggestions():
+    pass
+
+
+@then('check the route suggests <suggestion> for <code>')
+def check_route_suggestions(route, code, suggestion):
+    lookups = [TestAirportLookup, TestTrainLookup]
+    p = route_parser(lookups).parseString(route)
+    assert p[0]['mode'] is None
+    assert p[0]['suggestions'][code][0] == suggestion
+    assert list(p[0]['suggestions'].keys()) == [code]
+    assert fast_trip_leg(route + " 26-27 Jul 2013 in Dublin", lookups)['route'] == p[0]
+
+
+class BodyOnlyMessage():
+    def __init__(self, body):
+        self.body = body
+
+
+@scenario('travelcommand.feature', 'check a reply is rendered for a mistyped code')
+def test_mistyped_code_reply():
+    pass
+
+
+@then('check the reply asks whether a code was mistyped')
+def check_mistyped_code_reply(station_file, perdiem_files,
+                              sample_perdiem_query, monkeypatch):
+    tmpdir, locstrings, database = perdiem_files
+    CountingPerdiemDatabase.queries = []
+    CountingPerdiemDatabase.response = sample_perdiem_query
+    monkeypatch.setitem(
+        perdiem_cache._SHARED, (locstrings, str(database), None),
+        CachedPerdiemDatabase(locstrings, str(database),
+                              database_factory=CountingPerdiemDatabase))
+    airports = os.path.join(os.path.split(__file__)[0], 'test_data/airports.csv')
+    for body in ["qqx-dub 4-6 aug 2015", "qqx-dub 4-6 aug 2015 staying in Dublin"]:
+        action = TravelAction(BodyOnlyMessage(body))
+        action.set_config(dict(AIRPORT_DATA=airports,
+                               TRAIN_STATION_DATA=str(station_file),
+                               LOCSTRING_FILENAME=locstrings,
+                               DB_FILENAME=str(database),
+                               cost_estimators=["fake_qpx"]))
+        action.execute_action()
+        assert "I don't recognise the code QQX" in action.response_body
+        assert "Unable to estimate cost for this leg!" in action.response_body
+        assert "did you mean" in action.response_body_html
+    # only the leg that names a stay location is looked up
+    assert CountingPerdiemDatabase.queries == ["Dublin"]
+
+
+@scenario('travelcommand.feature', 'check routes are inferred for legs with only a location')
+def test_inferred_routes():
+    pass
+
+
+@then('check a route is inferred from the previous leg')
+def check_inferred_routes(airport_lookup):
+    lookups = [airport_lookup]
+    legs, skipped = parse_trip("5 May 2014 to 7 May 2014 in Manchester\n"
+                               "lhr->iad 7 May 2014 to 9 May 2014\n"
+                               "9 May 2014 to 11 May 2014 in Manchester\n"
+                               "11 May 2014 to 12 May 2014 in Washington, DC, USA\n",
+                               lookups)
+    inferred = list(inferred_routes(legs, endpoint_index(lookups)))
+    assert 'route' not in inferred[0]
+    assert inferred[1] is legs[1]
+    assert inferred[2]['route'] == dict(start='IAD', end='MHT', mode='air',
+                                        inferred=True)
+    assert inferred[3]['route']['end'] == 'IAD'
+
+
+@scenario('travelcommand.feature', 'check season lookup by interval index')
+def test_season_index():
+    pass
+
+
+@then('check <day> falls in the season starting <eff_date>')
+def check_season_index(sample_perdiem_query, day, eff_date):
+    seasons = sample_perdiem_query['closest_matches'][0]['seasons']
+    date = datetime.datetime.strptime(day, "%Y-%m-%d").date()
+    season = season_for_day(date, seasons)
+    if eff_date == 'none':
+        assert season is None
+    else:
+        assert season['eff_date'] == eff_date
+    # overlapping seasons resolve to the first listed
+    overlapping = SeasonIndex([dict(eff_date='01/01/2015', exp_date='12/31/2015'),
+                               dict(eff_date='06/01/2015', exp_date='06/30/2016')])
+    assert overlapping.season_for(datetime.date(2015, 7, 1))['eff_date'] == '01/01/2015'
+    assert overlapping.season_for(datetime.date(2016, 1, 1))['eff_date'] == '06/01/2015'
+
+
+@scenario('travelcommand.feature', 'check perdiem queries are cached')
+def test_perdiem_cache():
+    pass
+
+
+@given('a perdiem database on disk')
+def perdiem_files(tmpdir):
+    locstrings = tmpdir.join("locstrings.json")
+    locstrings.write("[]")
+    database = tmpdir.join("perdiem.json")
+    database.write("{}")
+    return tmpdir, str(locstrings), database
+
+
+class CountingPerdiemDatabase():
+    queries = []
+
+    def __init__(self, locstrings_filename, database_filename):
+        pass
+
+    def perdiem_query(self, location, threshold=90):
+        CountingPerdiemDatabase.queries.append(location)
+        return dict(CountingPerdiemDatabase.response,
+                    original_search_location=location)
+
+
+@then('check repeated queries are served from the cache')
+def check_perdiem_cache(sample_perdiem_query, perdiem_files):
+    tmpdir, locstrings, database = perdiem_files
+    CountingPerdiemDatabase.queries = []
+    CountingPerdiemDatabase.response = sample_perdiem_query
+
+    def cached_db():
+        return CachedPerdiemDatabase(locstrings, str(database),
+                                     str(tmpdir.join("cache.sqlite")),
+                                     database_factory=CountingPerdiemDatabase)
+    pd_db = cached_db()
+    first = pd_db.perdiem_query("Manchester, United Kingdom")
+    second = pd_db.perdiem_query("  manchester,   united kingdom")
+    assert CountingPerdiemDatabase.queries == ["Manchester, United Kingdom"]
+    assert second['original_search_location'] == "  manchester,   united kingdom"
+    assert dict(second, original_search_location=None) \
+      == dict(first, original_search_location=None)
+    assert pd_db.stats()['hits'] == 1
+
+    restarted = cached_db()
+    restarted.perdiem_query("Manchester, United Kingdom")
+    assert restarted.stats()['disk_hits'] == 1
+    assert len(CountingPerdiemDatabase.queries) == 1
+    restarted.perdiem_query("Manchester, United Kingdom", threshold=80)
+    assert len(CountingPerdiemDatabase.queries) == 2
+
+    database.write("{} ")
+    restarted.perdiem_query("Manchester, United Kingdom")
+    assert len(CountingPerdiemDatabase.queries) == 3
+
+
+@scenario('travelcommand.feature', 'check legs are estimated concurrently in order')
+def test_concurrent_estimates():
+    pass
+
+
+class SlowEstimator(RouteCostEstimator):
+    """
+    Answers every query after a delay depending on the origin, with a
+    single fare identifying the route
+    """
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.calls = []
+
+    @property
+    def name(self):
+        return "Slow"
+
+    @property
+    def travel_modes_serviced(self):
+        return ['air']
+
+    def single_estimate(self, start, end, date):
+        self.calls.append((start, end, date))
+        time.sleep(self.delays.get(start, 0))
+        return dict(found=True, estimator=self.name,
+                    fares=[float(len(self.calls))], route=start + end)
+
+    def roundtrip_estimate(self, start, end, date_out, date_back):
+        self.calls.append((start, end, date_out, date_back))
+        time.sleep(self.delays.get(start, 0))
+        return dict(found=True, estimator=self.name,
+                    fares=[100.0], route=start + end + start)
+
+
+@given('a slow estimator')
+def slow_estimator():
+    return SlowEstimator(dict(LHR=0.3, DUB=0.3, IAD=2.0))
+
+
+def costed_leg(start, end, day):
+    return dict(route=dict(start=start, end=end, mode='air'),
+                dates=dict(start=datetime.date(2015, 8, day),
+                           end=datetime.date(2015, 8, day + 1)),
+                staying_in=end,
+                costs=dict(matched_location=None, travel_cost=None))
+
+
+@given('a three leg trip')
+def three_leg_trip():
+    return [costed_leg('LHR', 'DUB', 1),
+            costed_leg('DUB', 'IAD', 3),
+            costed_leg('IAD', 'LHR', 5)]
+
+
+@then('check concurrent estimates keep leg order and respect the deadline')
+def check_concurrent_estimates(slow_estimator, three_leg_trip):
+    started = time.time()
+    costs = calculated_trip_costs(three_leg_trip, [slow_estimator],
+                                  max_workers=3, deadline=1.0)
+    assert time.time() - started < 1.5
+    travel_costs = [leg['costs']['travel_cost'] for leg in costs]
+    assert [cost.get('route') for cost in travel_costs] \
+      == ['LHRDUB', 'DUBIAD', None]
+    assert travel_costs[2]['timed_out']
+    # the pool, and so its threads' clients, is kept for the next trip
+    pool = shared_executor(3)
+    assert len(pool._threads) > 0
+    calculated_trip_costs(three_leg_trip[:1], [slow_estimator],
+                          max_workers=3, deadline=1.0)
+    assert shared_executor(3) is pool
+
+    # hung calls don't starve later trips of threads
+    released = threading.Event()
+    hung = FailingEstimator({})
+    hung.single_estimate = lambda start, end, date: released.wait(5)
+    date = datetime.date(2015, 8, 4)
+    hung_queries = [(hung, EstimateQuery(start, "DUB", date))
+                    for start in ("LHR", "IAD")]
+    assert all(result['timed_out'] for result in
+               run_estimate_queries(hung_queries, 2, deadline=0.1))
+    slow_estimator.delays = {}
+    healthy = run_estimate_queries(
+        [(slow_estimator, EstimateQuery("LHR", "DUB", date))], 2,
+        deadline=1.0)
+    released.set()
+    assert healthy[0]['found']
+
+
+@scenario('travelcommand.feature', 'check fares are cached with a time to live')
+def test_fare_cache():
+    pass
+
+
+@then('check cached fares expire and stale fares are refreshed')
+def check_fare_cache(slow_estimator, tmpdir):
+    now = [0]
+    slow_estimator.delays = {}
+    cache = CachingEstimator(slow_estimator, ttl=10, stale_ttl=10,
+                             cache_filename=str(tmpdir.join("fares.sqlite")),
+                             clock=lambda: now[0])
+    date = datetime.date(2015, 8, 4)
+    assert cache.single_estimate("LHR", "DUB", date)['fares'] == [1.0]
+    now[0] = 5
+    # each caller gets its own copy of a cached fare
+    cache.single_estimate("LHR", "DUB", date)['fares'] = None
+    assert cache.single_estimate("LHR", "DUB", date)['fares'] == [1.0]
+    assert len(slow_estimator.calls) == 1
+    # stale: served at once, refreshed behind the scenes
+    now[0] = 15
+    assert cache.single_estimate("LHR", "DUB", date)['fares'] == [1.0]
+    cache.wait_for_refreshes()
+    assert len(slow_estimator.calls) == 2
+    assert cache.single_estimate("LHR", "DUB", date)['fares'] == [2.0]
+    # a new cache on the same file starts warm
+    restarted = CachingEstimator(slow_estimator, ttl=10,
+                                 cache_filename=str(tmpdir.join("fares.sqlite")),
+                                 clock=lambda: now[0])
+    assert restarted.single_estimate("LHR", "DUB", date)['fares'] == [2.0]
+    now[0] = 40
+    assert restarted.single_estimate("LHR", "DUB", date)['fares'] == [3.0]
+    assert restarted.stats()['misses'] == 1
+    # the file is trimmed to its newest entries once it holds too many
+    bounded = CachingEstimator(slow_estimator, max_disk_entries=10,
+                               cache_filename=str(tmpdir.join("few.sqlite")),
+                               clock=lambda: now[0])
+    for day in range(1, 13):
+        now[0] = day
+        bounded.single_estimate("LHR", "DUB", datetime.date(2015, 8, day))
+    assert bounded._count_disk_entries() == 10
+    assert bounded._connection.execute(
+        "SELECT MIN(stored_at) FROM fares").fetchone()[0] == 3
+
+
+@scenario('travelcommand.feature', 'check identical in-flight fare queries are coalesced')
+def test_coalescing():
+    pass
+
+
+@then('check concurrent identical queries share one call')
+def check_coalescing(slow_estimator):
+    coalescing = CoalescingEstimator(slow_estimator)
+    date = datetime.date(2015, 8, 4)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(
+            lambda start: coalescing.single_estimate(start, "IAD", date),
+            ["LHR"] * 5 + ["DUB"]))
+    assert len(slow_estimator.calls) == 2
+    assert coalescing.flights.coalesced == 4
+    assert coalescing.flights.in_flight == 0
+    assert [result['route'] for result in results] == ["LHRIAD"] * 5 + ["DUBIAD"]
+    assert results[0] == results[1] and results[0] is not results[1]
+
+    # a leader ended by a BaseException still releases its waiters
+    flights = SingleFlight()
+    def interrupted():
+        time.sleep(0.2)
+        raise SystemExit()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flights.do, "key", interrupted)
+        time.sleep(0.05)
+        waiter = executor.submit(flights.do, "key", interrupted)
+        assert isinstance(waiter.exception(timeout=2), SystemExit)
+        assert isinstance(leader.exception(timeout=2), SystemExit)
+    assert flights.coalesced == 1 and flights.in_flight == 0
+
+    # a batch joins outstanding flights and sends only its leaders
+    batches = []
+    batching = SlowEstimator(dict(LHR=0.3))
+    batching.batch_estimate = lambda queries: batches.append(queries) or \
+      [batching.estimate(query) for query in queries]
+    coalescing = CoalescingEstimator(batching)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        outstanding = executor.submit(coalescing.single_estimate,
+                                      "LHR", "IAD", date)
+        time.sleep(0.05)
+        results = coalescing.batch_estimate(
+            [EstimateQuery(start, "IAD", date)
+             for start in ("LHR", "DUB", "DUB", "IAD")])
+    assert batches == [[EstimateQuery("DUB", "IAD", date),
+                        EstimateQuery("IAD", "IAD", date)]]
+    assert len(batching.calls) == 3
+    assert [result['route'] for result in results] == \
+      ["LHRIAD", "DUBIAD", "DUBIAD", "IADIAD"]
+    assert results[0] == outstanding.result() \
+      and results[0] is not outstanding.result()
+    assert results[1] is not results[2]
+    assert coalescing.flights.in_flight == 0
+
+
+@scenario('travelcommand.feature', 'check out and back legs are priced as one round trip')
+def test_roundtrip_pairing():
+    pass
+
+
+@then('check paired legs share one round trip estimate')
+def check_roundtrip_pairing(slow_estimator):
+    slow_estimator.delays = {}
+    legs = [costed_leg('LHR', 'DUB', 1),
+            costed_leg('DUB', 'IAD', 3),
+            costed_leg('IAD', 'DUB', 5),
+            costed_leg('DUB', 'LHR', 7),
+            costed_leg('LHR', 'IAD', 9)]
+    assert roundtrip_pairs(legs) == [(1, 2), (0, 3)]
+    costs = calculated_trip_costs(legs, [slow_estimator])
+    assert len(slow_estimator.calls) == 3
+    travel_costs = [leg['costs']['travel_cost'] for leg in costs]
+    assert [cost['fares'] for cost in travel_costs[:4]] == [[50.0]] * 4
+    assert [cost['route'] for cost in travel_costs[:4]] \
+      == ['LHRDUBLHR', 'DUBIADDUB', 'DUBIADDUB', 'LHRDUBLHR']
+    assert travel_costs[0]['roundtrip'] and 'roundtrip' not in travel_costs[4]
+    assert ('LHR', 'DUB', datetime.date(2015, 8, 1), datetime.date(2015, 8, 7)) \
+      in slow_estimator.calls
+
+
+class BatchingEstimator(SlowEstimator):
+    """
+    A SlowEstimator which records the batches it is sent
+    """
+
+    def __init__(self):
+        super().__init__({})
+        self.batches = []
+
+    def batch_estimate(self, queries):
+        self.batches.append(list(queries))
+        return super().batch_estimate(queries)
+
+
+@scenario('travelcommand.feature', "check a trip's fare searches are sent as one batch")
+def test_batch_estimates():
+    pass
+
+
+@given('a batching estimator')
+def batching_estimator():
+    return BatchingEstimator()
+
+
+@then('check sequential estimates are batched and cache misses rebatched')
+def check_batch_estimates(batching_estimator, three_leg_trip):
+    costs = calculated_trip_costs(three_leg_trip, [batching_estimator])
+    assert len(batching_estimator.batches) == 1
+    assert [query.start for query in batching_estimator.batches[0]] \
+      == ['LHR', 'DUB', 'IAD']
+    assert [leg['costs']['travel_cost']['route'] for leg in costs] \
+      == ['LHRDUB', 'DUBIAD', 'IADLHR']
+
+    cache = CachingEstimator(batching_estimator)
+    date = datetime.date(2015, 8, 1)
+    cache.single_estimate('LHR', 'DUB', date)
+    results = cache.batch_estimate([EstimateQuery('LHR', 'DUB', date),
+                                    EstimateQuery('DUB', 'IAD', date)])
+    assert batching_estimator.batches[-1] == [EstimateQuery('DUB', 'IAD', date)]
+    assert [result['route'] for result in results] == ['LHRDUB', 'DUBIAD']
+
+
+class FailingEstimator(SlowEstimator):
+
+    def single_estimate(self, start, end, date):
+        self.calls.append((start, end, date))
+        return self.error_response
+
+
+@scenario('travelcommand.feature', 'check estimator policy hedges, fails over and breaks circuits')
+def test_estimator_policy():
+    pass
+
+
+@then('check the backup estimator covers a slow or failing primary')
+def check_estimator_policy(slow_estimator):
+    date = datetime.date(2015, 8, 1)
+    backup = SlowEstimator({})
+    # a slow primary is hedged; the backup's answer comes back first
+    policy = PolicyEstimator([slow_estimator, backup], hedge_delay=0.05)
+    started = time.time()
+    assert policy.single_estimate('IAD', 'LHR', date)['route'] == 'IADLHR'
+    assert time.time() - started < 1.0
+    assert policy.hedges == 1 and len(backup.calls) == 1
+    # both slow: the per-call timeout gives up
+    policy = PolicyEstimator([slow_estimator, slow_estimator], timeout=0.2,
+                             hedge_delay=0.05)
+    assert policy.single_estimate('IAD', 'LHR', date)['timed_out']
+
+    # a failing primary fails over, and its circuit opens
+    now = [0]
+    failing = FailingEstimator({})
+    backup = SlowEstimator({})
+    policy = PolicyEstimator([failing, backup], failure_threshold=2,
+                             reset_after=30, clock=lambda: now[0])
+    for i in range(3):
+        assert policy.single_estimate('LHR', 'DUB', date)['found']
+    assert len(failing.calls) == 2 and len(backup.calls) == 3
+    assert policy.failovers == 2
+    assert policy.stats()['estimators'][0]['state'] == 'open'
+    # after reset_after one trial call is let through
+    now[0] = 31
+    policy.single_estimate('LHR', 'DUB', date)
+    assert len(failing.calls) == 3
+    assert policy.stats()['estimators'][0]['state'] == 'open'
+
+    # hung calls don't starve later queries of threads
+    released = threading.Event()
+    hung = FailingEstimator({})
+    hung.single_estimate = lambda start, end, date: released.wait(5)
+    policy = PolicyEstimator([hung], timeout=0.1, failure_threshold=10,
+                             max_workers=2)
+    for i in range(2):
+        assert policy.single_estimate('LHR', 'DUB', date)['timed_out']
+    policy.estimators = [SlowEstimator({})]
+    assert policy.single_estimate('LHR', 'DUB', date)['found']
+    released.set()
+
+
+@scenario('travelcommand.feature', 'check QPX responses are summarised')
+def test_fare_summary():
+    pass
+
+
+@given('a sample QPX response')
+def sample_qpx_response():
+    with open(os.path.join(MODULE_PATH[0], "fake_estimator",
+                           "sample_single_response.json")) as f:
+        return json.load(f)
+
+
+@then('check the fare summary of the sample response')
+def check_fare_summary(sample_qpx_response):
+    response = sample_qpx_response
+    summary = fare_summary(response)
+    options = response['trips']['tripOption']
+    assert len(summary['fares']) == len(options)
+    assert summary['fares'][0] == float(options[0]['saleTotal'][3:])
+    assert summary['min_fare'] == min(summary['fares'])
+    assert summary['min_fare'] <= summary['median_fare'] <= max(summary['fares'])
+    assert abs(summary['mean_fare'] * len(options) - sum(summary['fares'])) < 1e-6
+    assert 'EI' in summary['carriers']
+    assert fare_summary(dict(trips=dict()))['mean_fare'] is None
+
+
+@scenario('travelcommand.feature', 'check a QPX response with no flights is not a fare')
+def test_empty_qpx_response():
+    pass
+
+
+@then('check an empty QPX response gives the error response')
+def check_empty_qpx_response(fake_estimator):
+    empty = dict(trips=dict())
+    assert fake_estimator.formatted_response(empty) == \
+      fake_estimator.error_response
+    # so it is neither cached nor averaged as a fare
+    caching = CachingEstimator(fake_estimator)
+    assert not caching.cached_estimate(
+        "empty", lambda: fake_estimator.formatted_response(empty))['found']
+    assert caching.stats()['size'] == 0
+
+
+@scenario('travelcommand.feature', 'check one estimator can serve several threads')
+def test_estimator_threads():
+    pass
+
+
+@then('check concurrent estimates do not interfere')
+def check_estimator_threads(fake_estimator):
+    date = datetime.date(2015, 8, 4)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda start: fake_estimator.single_estimate(start, "DUB", date),
+            ["LHR", "IAD"] * 4))
+    assert [result['found'] for result in results] == [True, False] * 4
+    assert all(result['fares'][0] == 166.6 for result in results[::2])
+    # the fake never searches, so no client was ever built
+    assert fake_estimator._discovery is None
+    # the discovery document is fetched once, for the first client
+    from googleapiclient.http import HttpMockSequence
+    discovery = json.dumps(dict(
+        kind="discovery#restDescription", name="qpxExpress", version="v1",
+        rootUrl="https://www.googleapis.com/", servicePath="qpxExpress/v1/trips/",
+        resources=dict(trips=dict(methods=dict(search=dict(
+            id="qpxExpress.trips.search", path="search", httpMethod="POST")))),
+        schemas={}))
+    estimator = QPXCostEstimator("nokey")
+    first = estimator.build_service(HttpMockSequence([({'status': '200'},
+                                                       discovery)]))
+    second = estimator.build_service(HttpMockSequence([]))
+    assert first is not second and hasattr(second.trips(), 'search')
+    # each thread's own client gives up on a search after timeout seconds
+    assert estimator.service._http.timeout == 30
+
+
+@scenario('travelcommand.feature', 'check estimators are made from named specs on first use')
+def test_estimator_registry():
+    pass
+
+
+@given('an estimator registry')
+def estimator_registry():
+    registry = EstimatorRegistry()
+    registry.register("slow", SlowEstimator)
+    return registry
+
+
+@then('check specs make shared estimators and heavy imports are deferred')
+def check_estimator_registry(estimator_registry):
+    spec = dict(type="caching", ttl=60,
+                estimator=dict(type="slow", delays={}))
+    cache = estimator_registry.estimator(spec)
+    assert isinstance(cache, CachingEstimator) and cache.ttl == 60
+    assert isinstance(cache.estimator, SlowEstimator)
+    assert estimator_registry.estimator(dict(spec)) is cache
+    fake = estimator_registry.estimator("fake_qpx")
+    assert estimator_registry.estimators(["fake_qpx", cache]) == [fake, cache]
+    with pytest.raises(KeyError):
+        estimator_registry.estimator("no_such_estimator")
+    # a "module:attribute" spec is imported when first used
+    registry = EstimatorRegistry()
+    registry.register("rail_path", "cary_travelcommand.rail_fares:RailFareEstimator")
+    assert registry.factory("rail_path") is RailFareEstimator
+    # heavy dependencies are left until first use (see import_benchmark)
+    imported = import_times(PACKAGE_IMPORT
+                            + "; import cary_travelcommand.travel_costs")
+    assert "cary_travelcommand" in imported
+    for module in imported:
+        assert module.split(".")[0] not in DEFERRED_MODULES
+
+
+@scenario('travelcommand.feature', 'check recorded fares can be replayed offline')
+def test_record_replay():
+    pass
+
+
+@then('check a replayed cassette matches the recording')
+def check_record_replay(fake_estimator, tmpdir):
+    cassette = str(tmpdir.join("cassette"))
+    recorder = RecordingEstimator(fake_estimator, cassette)
+    out, back = datetime.date(2015, 8, 4), datetime.date(2015, 8, 5)
+    single = recorder.single_estimate("LHR", "DUB", out)
+    roundtrip = recorder.roundtrip_estimate("LHR", "DUB", out, back)
+    missing = recorder.single_estimate("LHR", "IAD", out)
+    assert single['found'] and roundtrip['found'] and not missing['found']
+
+    delays = []
+    replay = ReplayEstimator(cassette, latency=fixed_latency(0.5),
+                             sleep=delays.append)
+    assert len(replay) == 3
+    assert replay.single_estimate("LHR", "DUB", out) == single
+    assert replay.roundtrip_estimate("LHR", "DUB", out, back) == roundtrip
+    assert not replay.single_estimate("LHR", "IAD", out)['found']
+    assert not replay.single_estimate("DUB", "LHR", out)['found']
+    assert delays == [0.5] * 3 and replay.misses == 1
+
+    failing = ReplayEstimator(cassette, failure_rate=1.0, seed=1)
+    assert not failing.single_estimate("LHR", "DUB", out)['found']
+    assert failing.failures == 1
+
+
+@scenario('travelcommand.feature', 'check estimator calls are paced, prioritised and budgeted')
+def test_quota_scheduler():
+    pass
+
+
+@then('check interactive calls overtake bulk ones within the quota')
+def check_quota_scheduler(slow_estimator, tmpdir):
+    slow_estimator.delays = {}
+    date = datetime.date(2015, 8, 1)
+    scheduler = QuotaScheduler(slow_estimator, rate=10)
+    bulk = [scheduler.submit(EstimateQuery(start, 'IAD', date), BULK)
+            for start in ('LHR', 'DUB', 'CDG')]
+    interactive = scheduler.interactive.single_estimate('AMS', 'IAD', date)
+    for future in bulk:
+        future.result()
+    # the first bulk call may already be under way, but the rest wait
+    starts = [call[0] for call in slow_estimator.calls]
+    assert sorted(starts[:2]) == ['AMS', 'LHR'] and starts[2:] == ['DUB', 'CDG']
+    assert interactive['route'] == 'AMSIAD'
+    stats = scheduler.stats()
+    assert stats['queue_depth'] == 0 and stats['dispatched'] == 4
+    assert stats['bulk']['max_wait'] >= 0.2
+
+    day = [time.mktime((2015, 8, 1, 12, 0, 0, 0, 0, -1))]
+    budget = str(tmpdir.join("budget.sqlite"))
+    scheduler = QuotaScheduler(slow_estimator, rate=1000, daily_limit=2,
+                               budget_filename=budget,
+                               wall_clock=lambda: day[0])
+    results = scheduler.bulk.batch_estimate(
+        [EstimateQuery('LHR', 'DUB', date)] * 3)
+    assert [result['found'] for result in results] == [True, True, False]
+    assert results[2]['quota_exhausted']
+    restarted = QuotaScheduler(slow_estimator, rate=1000, daily_limit=2,
+                               budget_filename=budget,
+                               wall_clock=lambda: day[0])
+    assert restarted.interactive.single_estimate('LHR', 'DUB', date)['quota_exhausted']
+    day[0] += 24 * 3600
+    assert restarted.interactive.single_estimate('LHR', 'DUB', date)['found']
+    assert restarted.stats()['budget_remaining'] == 1
+
+
+@scenario('travelcommand.feature', 'check rail legs are priced from a local fare table')
+def test_rail_fares():
+    pass
+
+
+@given('a rail fare file')
+def rail_fare_file(tmpdir):
+    filename = str(tmpdir.join("fares.csv"))
+    with open(filename, "w") as f:
+        f.write("origin,destination,fare\n"
+                "KGX,EDB,150.00\n"
+                "kgx,edb,120.50\n"
+                "EDB,KGX,130.00\n"
+                "PAD,BRI,60\n"
+                "EUS,MAN,not a fare\n")
+    return filename
+
+
+@then('check rail fares are looked up offline')
+def check_rail_fares(rail_fare_file):
+    table = RailFareTable(rail_fare_file)
+    assert len(table) == 4
+    assert table.fare("KGX", "EDB") == 120.5
+    assert table.fare("EDB", "KGX") == 130.0
+    assert table.fare("BRI", "PAD") == 60.0
+    assert table.fare("EUS", "MAN") is None
+    assert RailFareTable(rail_fare_file, symmetric=False).fare("BRI", "PAD") is None
+
+    estimator = RailFareEstimator(rail_fare_file, currency_rate=2.0)
+    assert estimator.services('rail') and not estimator.services('air')
+    legs = [dict(costed_leg('KGX', 'EDB', 1), route=dict(start='KGX', end='EDB', mode='rail')),
+            dict(costed_leg('EDB', 'KGX', 3), route=dict(start='EDB', end='KGX', mode='rail')),
+            dict(costed_leg('EUS', 'MAN', 5), route=dict(start='EUS', end='MAN', mode='rail'))]
+    costs = [leg['costs']['travel_cost']
+             for leg in calculated_trip_costs(legs, [estimator])]
+    # out and back keep their own fares rather than half the pair
+    assert [cost['fares'] for cost in costs[:2]] == [[241.0], [260.0]]
+    assert 'roundtrip' not in costs[0] and not costs[2]['found']
+    assert estimator.table is shared_fare_table(rail_fare_file)
+    assert shared_fare_table(rail_fare_file, symmetric=False) \
+      is not estimator.table
+
+
+@scenario('travelcommand.feature', 'check vectorized per diem costs match the per-day dicts')
+def test_vectorized_perdiem():
+    pass
+
+
+@then('check vectorized costs give the same days and totals')
+def check_vectorized_perdiem(sample_perdiem_query, sample_trip_leg,
+                             sample_adjusted_costs):
+    pytest.importorskip("numpy")
+    adjusted = calculated_trip_costs(
+        trip_costs_by_perdiems([sample_trip_leg], [sample_perdiem_query],
+                               vectorized=True))
+    dates = adjusted[0]['costs']['dates']
+    expected = sample_adjusted_costs[0]['costs']['dates']
+    assert isinstance(dates, DayCosts)
+    assert [dict((key, day[key]) for key in day.keys()) for day in dates] \
+      == expected
+    assert dates[-1].lodging_multiplier == 0.0
+    assert [day['lodging_actual'] for day in dates] \
+      == dates.lodging_actual.tolist()
+    assert [day['mie_actual'] for day in dates] == dates.mie_actual.tolist()
+    assert lodgingcost_filter(adjusted[0]) \
+      == sum(day['lodging_actual'] for day in expected)
+    assert miecost_filter(adjusted[0]) \
+      == sum(day['mie_actual'] for day in expected)
+
+
+@scenario('travelcommand.feature', 'check long stays are costed as season spans')
+def test_season_spans():
+    pass
+
+
+@then('check span costs match daily costs for a long stay')
+def check_season_spans(sample_perdiem_query):
+    legs = [{'route': None,
+             'dates': {'start': datetime.date(2015, 1, 10),
+                       'end': datetime.date(2015, 9, 30)},
+             'staying_in': "Manchester"},
+            {'route': None,
+             'dates': {'start': datetime.date(2015, 9, 30),
+                       'end': datetime.date(2015, 9, 30)},
+             'staying_in': "Manchester"}]
+    daily = calculated_trip_costs(
+        trip_costs_by_perdiems(legs, [sample_perdiem_query] * 2))
+    spans = calculated_trip_costs(
+        trip_costs_by_perdiems(legs, [sample_perdiem_query] * 2, spans=True))
+    for (day_leg, span_leg) in zip(daily, spans):
+        day_dates = day_leg['costs']['dates']
+        span_dates = span_leg['costs']['dates']
+        assert sum(span['days'] for span in span_dates) == len(day_dates)
+        assert lodgingcost_filter(span_leg) == lodgingcost_filter(day_leg)
+        assert miecost_filter(span_leg) == miecost_filter(day_leg)
+    long_stay = spans[0]['costs']['dates']
+    assert len(long_stay) < 10
+    assert long_stay[0]['days'] == 1 and long_stay[0]['mie_multiplier'] == 0.75
+    assert long_stay[-1]['days'] == 1 and long_stay[-1]['lodging_multiplier'] == 0.0
+    assert all(a['last_day'] + datetime.timedelta(days=1) == b['day']
+               for (a, b) in zip(long_stay, long_stay[1:]))
+    assert spans[1]['costs']['dates'][0]['day'] == spans[1]['costs']['dates'][0]['last_day']
+    # spans win over vectorized costs
+    both = calculated_trip_costs(
+        trip_costs_by_perdiems(legs, [sample_perdiem_query] * 2,
+                               vectorized=True, spans=True))
+    assert both[0]['costs']['dates'] == long_stay
+
+
+@scenario('travelcommand.feature', 'check many trips are costed in bulk')
+def test_bulk_costing():
+    pass
+
+
+@then('check bulk costs match single trip costs and share queries')
+def check_bulk_costing(sample_perdiem_query, perdiem_files, slow_estimator):
+    tmpdir, locstrings, database = perdiem_files
+    CountingPerdiemDatabase.queries = []
+    CountingPerdiemDatabase.response = sample_perdiem_query
+    slow_estimator.delays = {}
+    airports = os.path.join(os.path.split(__file__)[0], 'test_data/airports.csv')
+    trips = ["LHR-DUB 4-5 August 2015 staying in Manchester\n"
+             "DUB-LHR 5 August 2015 staying in manchester\n"
+             "this line is not a leg",
+             [costed_leg('LHR', 'DUB', 4)],
+             "LHR-DUB 4-5 August 2015 staying in MANCHESTER"]
+    arguments = dict(route_estimators=[slow_estimator],
+                     lookup_files=[(AirportLookup, airports)],
+                     database_factory=CountingPerdiemDatabase,
+                     batch_size=3)
+    with BulkTripCoster(locstrings, str(database), processes=0,
+                        **arguments) as coster:
+        results = list(coster.costs(trips))
+    assert [len(result.costs) for result in results] == [2, 1, 1]
+    assert [len(result.skipped_lines) for result in results] == [1, 0, 0]
+    # one per diem query per distinct location, one search per distinct fare
+    assert len(CountingPerdiemDatabase.queries) == 2
+    assert coster.stats() == dict(legs=4, perdiem_queries=2)
+    assert len(slow_estimator.calls) == 2
+    first = results[0].costs
+    assert first[0]['costs']['travel_cost']['roundtrip']
+    assert first[1]['costs']['searched_location'] == 'manchester'
+    assert lodgingcost_filter(results[2].costs[0]) \
+      == lodgingcost_filter(adjusted_trip_costs(
+          parse_trip(trips[2], [AirportLookup(airports)])[0],
+          CachedPerdiemDatabase(locstrings, str(database),
+                                database_factory=CountingPerdiemDatabase),
+          [slow_estimator])[0])
+
+    # the slow estimator's fares count its calls, so compare the rest
+    def without_fares(results):
+        return [[dict(leg, costs=dict(leg['costs'], travel_cost=None))
+                 for leg in result.costs] for result in results]
+    searched = len(slow_estimator.calls)
+    pooled = list(bulk_trip_costs(trips, locstrings, str(database),
+                                  processes=2, **arguments))
+    assert without_fares(pooled) == without_fares(results)
+    assert len(slow_estimator.calls) - searched == 2
+    assert [result.skipped_lines for result in pooled] \
+      == [result.skipped_lines for result in results]
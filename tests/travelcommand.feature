@@ -78,3 +78,163 @@ Feature: Travel command
   Scenario: check fake estimator
     Given a test estimator
     Then check a test flight can be estimated
+
+  Scenario: check trip grammar is compiled once
+    Given a trip parser
+    Then check the trip parser is reused
+    And check a two leg trip parses
+
+  Scenario Outline: check fast leg parsing matches the grammar
+    Given a <leg>
+    And a trip leg parser
+    Then check the fast parser gives the same leg
+
+    Examples:
+    | leg                                                   |
+    | lhr->dub 26-27 Jul 2013                               |
+    | lhr - dub 2013/07/26-2013/07/27                       |
+    | lhr->dub 26 Jul 2013 to 27 Jul 2013                   |
+    | 5 May 2014 to 7 May 2014 in Manchester                |
+    | 4-6 jun 2016 in Baltimore, MD, USA                    |
+    | 4-6 jun 2016 staying in wright-patterson afb, OH, USA |
+    | lhr->dub 26 Jul-27 Jul 2013                           |
+    | lhr->dub 31 Jan to 2 feb 2014                         |
+    | lhr->dub 20 Jan 2015                                  |
+
+  Scenario: check unparseable lines are skipped
+    Given a trip with a bad line
+    Then check the good legs are parsed and the bad line reported
+
+  Scenario: check a signature and quoted reply are not parsed
+    Given a trip with a signature
+    Then check only the legs are parsed
+
+  Scenario: check shared lookups are reloaded only when their file changes
+    Given an airport file
+    Then check the shared lookup is reused until the file changes
+
+  Scenario Outline: check snapshot lookups match the airport table
+    Given a dict from airport csv
+    And a compiled airport snapshot
+    Then check the snapshot agrees for <identifier>
+
+    Examples:
+    | identifier |
+    | LHR        |
+    | IAD        |
+    | AAA        |
+    | ZZV        |
+    | XQQ        |
+
+  Scenario: check station lookup from an ATOC location file
+    Given a station location file
+    Then check the stations are loaded with normalized cities
+
+  Scenario Outline: check mistyped codes get suggestions
+    Given a <route>
+    Then check the route suggests <suggestion> for <code>
+
+    Examples:
+    | route    | code | suggestion |
+    | lrh->dub | LRH  | LHR        |
+    | lhr->dbu | DBU  | DUB        |
+    | kgx-cgb  | CGB  | CBG        |
+
+  Scenario: check a reply is rendered for a mistyped code
+    Given a station location file
+    And a perdiem database on disk
+    And a sample perdiem query
+    Then check the reply asks whether a code was mistyped
+
+  Scenario: check routes are inferred for legs with only a location
+    Given a dict from airport csv
+    Then check a route is inferred from the previous leg
+
+  Scenario Outline: check season lookup by interval index
+    Given a sample perdiem query
+    Then check <day> falls in the season starting <eff_date>
+
+    Examples:
+    | day        | eff_date   |
+    | 2014-09-30 | none       |
+    | 2014-10-01 | 10/01/2014 |
+    | 2015-01-31 | 10/01/2014 |
+    | 2015-02-01 | 02/01/2015 |
+    | 2015-06-30 | 02/01/2015 |
+    | 2015-07-01 | 07/01/2015 |
+    | 2049-12-31 | 07/01/2015 |
+    | 2050-01-01 | none       |
+
+  Scenario: check perdiem queries are cached
+    Given a sample perdiem query
+    And a perdiem database on disk
+    Then check repeated queries are served from the cache
+
+  Scenario: check legs are estimated concurrently in order
+    Given a slow estimator
+    And a three leg trip
+    Then check concurrent estimates keep leg order and respect the deadline
+
+  Scenario: check fares are cached with a time to live
+    Given a slow estimator
+    Then check cached fares expire and stale fares are refreshed
+
+  Scenario: check identical in-flight fare queries are coalesced
+    Given a slow estimator
+    Then check concurrent identical queries share one call
+
+  Scenario: check out and back legs are priced as one round trip
+    Given a slow estimator
+    Then check paired legs share one round trip estimate
+
+  Scenario: check a trip's fare searches are sent as one batch
+    Given a batching estimator
+    Then check sequential estimates are batched and cache misses rebatched
+
+  Scenario: check estimator policy hedges, fails over and breaks circuits
+    Given a slow estimator
+    Then check the backup estimator covers a slow or failing primary
+
+  Scenario: check QPX responses are summarised
+    Given a sample QPX response
+    Then check the fare summary of the sample response
+
+  Scenario: check a QPX response with no flights is not a fare
+    Given a test estimator
+    Then check an empty QPX response gives the error response
+
+  Scenario: check one estimator can serve several threads
+    Given a test estimator
+    Then check concurrent estimates do not interfere
+
+  Scenario: check estimators are made from named specs on first use
+    Given an estimator registry
+    Then check specs make shared estimators and heavy imports are deferred
+
+  Scenario: check recorded fares can be replayed offline
+    Given a test estimator
+    Then check a replayed cassette matches the recording
+
+  Scenario: check estimator calls are paced, prioritised and budgeted
+    Given a slow estimator
+    Then check interactive calls overtake bulk ones within the quota
+
+  Scenario: check rail legs are priced from a local fare table
+    Given a rail fare file
+    Then check rail fares are looked up offline
+
+  Scenario: check vectorized per diem costs match the per-day dicts
+    Given a sample perdiem query
+    And a sample trip leg
+    And a sample adjusted cost
+    Then check vectorized costs give the same days and totals
+
+  Scenario: check long stays are costed as season spans
+    Given a sample perdiem query
+    Then check span costs match daily costs for a long stay
+
+  Scenario: check many trips are costed in bulk
+    Given a sample perdiem query
+    And a perdiem database on disk
+    And a slow estimator
+    Then check bulk costs match single trip costs and share queries